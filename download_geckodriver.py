@@ -4,6 +4,7 @@ import logging
 import platform
 import os
 from zipfile import ZipFile
+from file_handling.dl_fn1 import DownloadCache
 
 # Github has a very organized release tagging.
 # The structure of the download link is predictable, hence it is easy to make
@@ -30,6 +31,8 @@ def init_log():
 
 
 logger = init_log()
+# geckodriver zips are reused from here when the release has not changed.
+gecko_cache = DownloadCache()
 
 
 def os_architecture():
@@ -72,11 +75,12 @@ def get_latest_dl_link():
     return f"{dl_base_url}/{filename}", filename
 
 
-def download_gecko_for_win(path=None):
+def download_gecko_for_win(path=None, cache=gecko_cache):
     """
     This is a very basic download function, if the file is as huge as gigabytes,
     consider using chunk size to download chunk by chunk by turning on stream with requests.get().
     :param path: If not stated will download geckodriver to current working directory.
+    :param cache: DownloadCache, a zip already in the cache is not downloaded again. None to always download.
     :return: The string of the geckodriver abs path.
     """
     if path is None:
@@ -89,6 +93,11 @@ def download_gecko_for_win(path=None):
         os.makedirs(save_path, exist_ok=True)
     dl_file_info = get_latest_dl_link()
     save_to = f"{save_path}\\{dl_file_info[1]}"
+    if cache is not None:
+        logger.info(f"Fetching {dl_file_info[1]} through the download cache in {cache.cache_dir}...")
+        cache.fetch(dl_file_info[0], save_to, connections=1)
+        logger.info(f"Please find the file in {save_to}.")
+        return save_to
     r = requests.get(dl_file_info[0], allow_redirects=True)
     with open(save_to, "wb") as dl:
         logger.info(f"Downloading {dl_file_info[1]}...")
@@ -4,50 +4,131 @@
 # The scripts that are written use type hinting to assist in using the functions
 import os
 import sys
+import json
 import requests
+import requests.adapters
 from pathlib import Path
 import shutil
 from tqdm import tqdm
-from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+from time import monotonic, sleep, time
+from hashlib import sha256
+from urllib.parse import urlsplit, unquote
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 
-def get_file_name(url: str):
+# probe_url results by url, entries are (monotonic time, probe).
+_probes = dict()
+_probes_lock = Lock()
+PROBE_TTL = 300
+
+
+def filename_from_disposition(disposition: str):
+    """
+    Get the file name from the Content-Disposition header,
+    filename*= (RFC 5987, eg. UTF-8''na%C3%AFve.txt) is preferred over filename=.
+    :param disposition: value of Content-Disposition.
+    :return: filename in string, None if there is none.
+    """
+    params = dict()
+    for param in disposition.split(";")[1:]:
+        key, _, value = param.strip().partition("=")
+        params[key.strip().lower()] = value.strip().strip('"')
+    if params.get("filename*"):
+        _, _, value = params["filename*"].partition("''")
+        return os.path.basename(unquote(value)) or None
+    if params.get("filename"):
+        return os.path.basename(params["filename"]) or None
+    return None
+
+
+def probe_url(url: str, session: requests.Session = None, ttl: float = None):
+    """
+    Resolve everything the download needs from one HEAD request, redirects are followed once
+    and the final url is used for the GET, so there are no more HEAD requests before the first byte.
+    The result is cached per url for ttl seconds.
+    :param url: the download link
+    :param session: requests.Session to reuse connections, default is a new connection.
+    :param ttl: seconds the result is reused, default is PROBE_TTL, 0 always probes.
+    :return: dictionary of url (final url after redirects), filename, size (0 if unknown),
+    accept_ranges, etag and last_modified.
+    """
+    ttl = PROBE_TTL if ttl is None else ttl
+    with _probes_lock:
+        cached = _probes.get(url)
+    if cached and monotonic() - cached[0] < ttl:
+        return cached[1]
+    r = (session or requests).head(url, allow_redirects=True)
+    header = r.headers
+    final_url = r.url or url
+    filename = filename_from_disposition(header.get("Content-Disposition", ""))
+    if not filename:
+        filename = os.path.basename(url)
+        fname, extension = os.path.splitext(filename)
+        if extension and "=" in filename:
+            filename = filename.split("=")[-1]
+        elif not extension:
+            filename = os.path.basename(unquote(urlsplit(final_url).path)) or filename
+    try:
+        size = int(header.get("Content-Length", 0))
+    except ValueError:
+        size = 0
+    probe = dict(url=final_url, filename=filename, size=size,
+                 accept_ranges=header.get("Accept-Ranges", "").lower() == "bytes",
+                 etag=header.get("ETag"), last_modified=header.get("Last-Modified"))
+    if r.ok:
+        with _probes_lock:
+            _probes[url] = (monotonic(), probe)
+    return probe
+
+
+def get_file_name(url: str, session: requests.Session = None):
     """
     This function gets the file name from the download link. Works for most websites.
     Do not work on files hosted in content delivery website, as retrieval of file from CDN
-    uses unique session keys which are hard to determine.
+    uses unique session keys which are hard to determine, unless the server sends Content-Disposition.
     :param url: the download link
+    :param session: requests.Session to reuse connections, default is a new connection.
     :return: filename in string.
     """
-    filename = os.path.basename(url)
-    fname, extension = os.path.splitext(filename)
-    if extension:
-        if "=" in filename:
-            return filename.split("=")[-1]
-        return filename
-    header = requests.head(url).headers
-    if "Location" in header:
-        return os.path.basename(header["Location"])
-    return filename
+    return probe_url(url, session=session)["filename"]
 
 
-def get_file_size(url: str):
+def get_file_size(url: str, session: requests.Session = None):
     """
     This function only works if Content-Length is in the header,
     files hosted in CDN will not work as there is no content-length or
     content-length is not accurate.
     Knowing the file size is useful for implementing progress bar.
     :param url:
-    :return:
+    :param session: requests.Session to reuse connections, default is a new connection.
+    :return: size in bytes, 0 if unknown.
     """
-    header = requests.head(url).headers
-    if "Content-Length" in header and header["Content-Length"] != 0:
-        return int(header["Content-Length"])
-    elif "Location" in header:
-        h = requests.head(header["Location"]).headers
-        return int(h.get("Content-Length", 0))
-    else:
-        return 0
+    return probe_url(url, session=session)["size"]
+
+
+def accept_ranges(url: str, session: requests.Session = None):
+    """
+    This function checks if the server allows the file to be downloaded in parts
+    with the Range header, which is needed for segmented downloads.
+    :param url: the download link
+    :param session: requests.Session to reuse connections, default is a new connection.
+    :return: True if Accept-Ranges is bytes.
+    """
+    return probe_url(url, session=session)["accept_ranges"]
+
+
+def get_validators(url: str, session: requests.Session = None):
+    """
+    This function gets the ETag and Last-Modified of the file, if either changes
+    the file on the server is not the same file and a partial download cannot be resumed.
+    :param url: the download link
+    :param session: requests.Session to reuse connections, default is a new connection.
+    :return: dictionary of etag and last_modified, None if the server does not send it.
+    """
+    probe = probe_url(url, session=session)
+    return dict(etag=probe["etag"], last_modified=probe["last_modified"])
 
 
 def set_save_to(filename, subdir="Downloads"):
@@ -64,33 +145,635 @@ def set_save_to(filename, subdir="Downloads"):
     return os.path.join(path, filename)
 
 
-def file_dl(url: str, fdst: str = "Temps"):
+class Throttle:
     """
-    This function download the files from the download link.
-    TQDM is used to keep track on the download progress,
+    Token bucket shared by downloads to cap their aggregate bandwidth,
+    each download consumes the bytes it receives and sleeps once the bucket is in debt.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        """
+        :param rate: bytes per second.
+        :param burst: bytes that can be received at once after an idle period, default is one second of rate.
+        """
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self._updated = monotonic()
+        self._lock = Lock()
+
+    def consume(self, amount: int):
+        with self._lock:
+            now = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            sleep(wait)
+
+
+def copyfileobj(fsrc, fdst, throttle: Throttle = None, length: int = 65536):
+    """
+    shutil.copyfileobj with an optional bandwidth cap.
+    """
+    if throttle is None:
+        return shutil.copyfileobj(fsrc, fdst, length)
+    while True:
+        buf = fsrc.read(length)
+        if not buf:
+            break
+        throttle.consume(len(buf))
+        fdst.write(buf)
+
+
+class PartFile:
+    """
+    The download is written to save_to.part, the sidecar save_to.part.json records the url,
+    validators, size and the byte ranges already written.
+    An interrupted download continues from the ranges that are missing,
+    the partial file is discarded if the url, size or validators are different.
+    """
+
+    def __init__(self, save_to: str, url: str, size: int, validators: dict, save_interval: float = 1.0):
+        """
+        :param save_to: abs path of the completed download.
+        :param url: download link
+        :param size: file size in bytes, 0 if unknown.
+        :param validators: dictionary of etag and last_modified, see get_validators.
+        :param save_interval: minimum seconds between sidecar writes while downloading.
+        """
+        self.save_to = save_to
+        self.path = save_to + ".part"
+        self.sidecar = self.path + ".json"
+        self.url = url
+        self.size = size
+        self.validators = validators
+        self.save_interval = save_interval
+        self.done = []
+        self._saved_at = 0
+        self._lock = Lock()
+        self._load()
+
+    @property
+    def resumable(self):
+        # without a validator there is no way to know if the partial file belongs to the same file.
+        return bool(self.size and (self.validators.get("etag") or self.validators.get("last_modified")))
+
+    @property
+    def if_range(self):
+        return self.validators.get("etag") or self.validators.get("last_modified")
+
+    @property
+    def completed(self):
+        return sum(end - start + 1 for start, end in self.done)
+
+    def _load(self):
+        state = None
+        if self.resumable and os.path.exists(self.path) and os.path.exists(self.sidecar):
+            try:
+                with open(self.sidecar) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = None
+        if state and state.get("url") == self.url and state.get("size") == self.size \
+                and state.get("validators") == self.validators:
+            self.done = [tuple(done) for done in state.get("done", [])]
+        else:
+            self.discard()
+
+    def save(self, force: bool = False):
+        """
+        Write the sidecar, at most once every save_interval unless force.
+        """
+        with self._lock:
+            if not force and monotonic() - self._saved_at < self.save_interval:
+                return
+            self._saved_at = monotonic()
+            state = dict(url=self.url, size=self.size, validators=self.validators, done=self.done)
+            with open(self.sidecar + ".tmp", "w") as f:
+                json.dump(state, f)
+            os.replace(self.sidecar + ".tmp", self.sidecar)
+
+    def add(self, start: int, end: int):
+        """
+        Record bytes start to end (inclusive) as written, adjacent ranges are merged.
+        """
+        if end < start:
+            return
+        with self._lock:
+            merged = []
+            for done in sorted(self.done + [(start, end)]):
+                if merged and done[0] <= merged[-1][1] + 1:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], done[1]))
+                else:
+                    merged.append(done)
+            self.done = merged
+        self.save()
+
+    def missing(self, start: int, end: int):
+        """
+        :return: list of (start, end) ranges between start and end that are not written yet.
+        """
+        holes = []
+        for done_start, done_end in self.done:
+            if done_end < start or done_start > end:
+                continue
+            if done_start > start:
+                holes.append((start, done_start - 1))
+            start = done_end + 1
+        if start <= end:
+            holes.append((start, end))
+        return holes
+
+    def open(self):
+        """
+        Open the partial file for writing at any position, it is created and preallocated if missing.
+        The ranges of a segmented download open it concurrently, only one of them may create it,
+        a second truncate would wipe the chunks already written.
+        """
+        with self._lock:
+            if not os.path.exists(self.path):
+                with open(self.path, "wb") as f:
+                    f.truncate(self.size)
+        return open(self.path, "r+b")
+
+    def discard(self):
+        self.done = []
+        for path in (self.path, self.sidecar):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def finish(self):
+        """
+        Move the completed download to save_to and remove the sidecar.
+        """
+        os.replace(self.path, self.save_to)
+        if os.path.exists(self.sidecar):
+            os.remove(self.sidecar)
+
+
+def download_range(url: str, part: PartFile, start: int, end: int, progress: tqdm, chunk_size: int = 65536,
+                   session: requests.Session = None, throttle: Throttle = None):
+    """
+    Download the bytes start to end (inclusive) of the file into the same position of the partial file,
+    every chunk written is recorded in the sidecar so an interrupted range resumes where it stopped.
+    :param url: download link
+    :param part: PartFile of the download.
+    :param start: first byte.
+    :param end: last byte.
+    :param progress: tqdm progress bar shared by all the ranges.
+    :param chunk_size: bytes read per iteration.
+    :param session: requests.Session to reuse connections, default is a new connection.
+    :param throttle: Throttle to cap the bandwidth, default is no cap.
+    :return: number of bytes written.
+    """
+    written = 0
+    headers = {"Range": f"bytes={start}-{end}"}
+    if part.if_range:
+        headers["If-Range"] = part.if_range
+    with (session or requests).get(url, headers=headers, stream=True) as r, part.open() as f:
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise ValueError(f"{url} did not return the range {start}-{end}.")
+        f.seek(start)
+        for chunk in r.iter_content(chunk_size=chunk_size):
+            if throttle:
+                throttle.consume(len(chunk))
+            f.write(chunk)
+            part.add(start + written, start + written + len(chunk) - 1)
+            written += len(chunk)
+            progress.update(len(chunk))
+    if written != end - start + 1:
+        raise ValueError(f"Range {start}-{end} of {url} is incomplete, {written} bytes received.")
+    return written
+
+
+def segmented_dl(url: str, part: PartFile, connections: int = 4, desc: str = None,
+                 session: requests.Session = None, throttle: Throttle = None):
+    """
+    Split the file into byte ranges and download them concurrently into a preallocated file,
+    multiple tcp connections use much more of the bandwidth of high latency links than one.
+    Ranges already in the partial file are skipped.
+    :param url: download link
+    :param part: PartFile of the download.
+    :param connections: number of ranges downloaded at the same time.
+    :param desc: prefix of the progress bar.
+    :param session: requests.Session to reuse connections, default is a new connection.
+    :param throttle: Throttle to cap the bandwidth, default is no cap.
+    :return:
+    """
+    size = part.size
+    segment = -(-size // connections)
+    ranges = [hole for start in range(0, size, segment)
+              for hole in part.missing(start, min(start + segment, size) - 1)]
+    try:
+        with tqdm(total=size, initial=part.completed, unit="B", unit_scale=True, unit_divisor=1024, desc=desc,
+                  file=sys.stdout) as progress, ThreadPoolExecutor(max_workers=connections) as e:
+            futures = [e.submit(download_range, url, part, start, end, progress,
+                                 session=session, throttle=throttle) for start, end in ranges]
+            for future in futures:
+                future.result()
+    finally:
+        part.save(force=True)
+
+
+def stream_dl(url: str, part: PartFile, desc: str = None, resume: bool = True,
+              session: requests.Session = None, throttle: Throttle = None):
+    """
+    Download the file over one connection, TQDM is used to keep track on the download progress,
     This examples show how to use tqdm with shutil.copyfileobj.
     Searching from the internet it is more common to find
     for chunk in chunk_size:
         f.write(chunk)
         pbar.update(len(chunk))
+    If the partial file has the beginning of the file only the rest is requested.
+    :param url: download link
+    :param part: PartFile of the download.
+    :param desc: prefix of the progress bar.
+    :param resume: False to start from byte zero, eg. the server does not accept ranges.
+    :param session: requests.Session to reuse connections, default is a new connection.
+    :param throttle: Throttle to cap the bandwidth, default is no cap.
+    :return:
+    """
+    offset = part.done[0][1] + 1 if resume and part.done and part.done[0][0] == 0 else 0
+    headers = dict()
+    if offset:
+        headers = {"Range": f"bytes={offset}-", "If-Range": part.if_range}
+    with (session or requests).get(url, headers=headers, stream=True) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            # the server sends the whole file if it has changed since the partial download.
+            offset = 0
+            part.discard()
+        with part.open() as f, tqdm.wrapattr(
+                r.raw,
+                "read",
+                total=part.size,
+                initial=offset,
+                unit="B",
+                unit_scale=True,
+                unit_divisor=1024,
+                desc=desc,
+                file=sys.stdout
+        ) as raw:
+            f.seek(offset)
+            try:
+                copyfileobj(raw, f, throttle=throttle)
+            finally:
+                f.flush()
+                part.add(offset, f.tell() - 1)
+                part.save(force=True)
+    if part.size and part.completed < part.size:
+        raise ValueError(f"{url} is incomplete, {part.completed} of {part.size} bytes received.")
+
+
+def resumable_dl(url: str, save_to: str, connections: int = 4, min_segment_size: int = 1024 * 1024,
+                 desc: str = None, session: requests.Session = None, throttle: Throttle = None,
+                 probe: dict = None):
+    """
+    Download to save_to.part and move it to save_to once complete, see PartFile.
+    If the server accepts ranges and the file is large enough the file is downloaded
+    in segments over several connections, see segmented_dl, otherwise see stream_dl.
+    Run it again after an interruption to continue the download.
+    The size, validators and final url come from probe_url.
+    :param url: download link
+    :param save_to: abs path to save to.
+    :param connections: maximum number of connections for a segmented download, 1 disables it.
+    :param min_segment_size: files smaller than two segments are downloaded over one connection.
+    :param desc: prefix of the progress bar, default is the file name.
+    :param session: requests.Session to reuse connections, default is a new connection.
+    :param throttle: Throttle to cap the bandwidth, default is no cap.
+    :param probe: result of probe_url for the url, probed if None.
+    :return: save_to
+    """
+    probe = probe or probe_url(url, session=session)
+    size = probe["size"]
+    final_url = probe["url"]
+    desc = desc or os.path.basename(save_to)
+    part = PartFile(save_to, url, size, dict(etag=probe["etag"], last_modified=probe["last_modified"]))
+    ranges = bool(size) and probe["accept_ranges"]
+    if ranges and part.completed == size:
+        part.finish()
+        return save_to
+    if ranges and connections > 1 and size >= 2 * min_segment_size:
+        connections = min(connections, size // min_segment_size)
+        try:
+            segmented_dl(final_url, part, connections=connections, desc=desc, session=session, throttle=throttle)
+            part.finish()
+            return save_to
+        except ValueError:
+            # the server advertised ranges but did not honour them, start over with one stream.
+            part.discard()
+    stream_dl(final_url, part, desc=desc, resume=ranges, session=session, throttle=throttle)
+    part.finish()
+    return save_to
+
+
+class DownloadCache:
+    """
+    Local cache of downloaded files, blobs are stored once by sha256 of the content and
+    index.json maps every url to its blob, validators and last use.
+    A cached url is revalidated with If-None-Match/If-Modified-Since, on 304 the blob is
+    hardlinked (copied if the filesystem cannot link) to the destination without downloading it again.
+    Least recently used entries are evicted once the blobs exceed max_bytes.
+    Hardlinked files share the blob, do not modify downloaded files in place.
+    """
+
+    def __init__(self, cache_dir: str = None, max_bytes: int = 10 * 1024 ** 3):
+        """
+        :param cache_dir: directory of the cache, default is .cache/dl_fn1 under the home directory.
+        :param max_bytes: maximum total size of the cached blobs.
+        """
+        self.cache_dir = cache_dir or os.path.join(Path.home(), ".cache", "dl_fn1")
+        self.blob_dir = os.path.join(self.cache_dir, "blobs")
+        self.tmp_dir = os.path.join(self.cache_dir, "tmp")
+        self.index_path = os.path.join(self.cache_dir, "index.json")
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def _write_index(self, index):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def blob_path(self, sha: str):
+        return os.path.join(self.blob_dir, sha)
+
+    def entry(self, url: str):
+        """
+        :return: index entry of the url if its blob is intact, otherwise None.
+        """
+        with self._lock:
+            entry = self._read_index().get(url)
+        if entry and os.path.exists(self.blob_path(entry["sha256"])) \
+                and os.path.getsize(self.blob_path(entry["sha256"])) == entry["size"]:
+            return entry
+        return None
+
+    def revalidate(self, url: str, entry: dict, session: requests.Session = None):
+        """
+        Conditional GET of the url.
+        :return: True if the server answers 304 Not Modified.
+        """
+        headers = dict()
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        if not headers:
+            return False
+        with (session or requests).get(url, headers=headers, stream=True) as r:
+            return r.status_code == 304
+
+    def link(self, sha: str, save_to: str):
+        """
+        Hardlink the blob to save_to, copy it if hardlinks are not supported, eg. across filesystems.
+        """
+        if os.path.exists(save_to):
+            os.remove(save_to)
+        try:
+            os.link(self.blob_path(sha), save_to)
+        except OSError:
+            shutil.copyfile(self.blob_path(sha), save_to)
+
+    def add(self, url: str, path: str, validators: dict, filename: str = None):
+        """
+        Move a downloaded file into the cache.
+        :param url: download link
+        :param path: abs path of the downloaded file, it is moved to the blob directory.
+        :param validators: dictionary of etag and last_modified.
+        :param filename: filename of the download, reused on the next fetch without probing.
+        :return: sha256 of the file.
+        """
+        digest = sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        sha = digest.hexdigest()
+        os.makedirs(self.blob_dir, exist_ok=True)
+        size = os.path.getsize(path)
+        # under the lock so that evict does not take the new blob for an orphan.
+        with self._lock:
+            if os.path.exists(self.blob_path(sha)):
+                os.remove(path)
+            else:
+                os.replace(path, self.blob_path(sha))
+            index = self._read_index()
+            previous = index.get(url)
+            index[url] = dict(sha256=sha, size=size, filename=filename, used=time(), **validators)
+            self._write_index(index)
+            # the content of the url changed, its previous blob is deleted unless another url has it.
+            if previous and previous["sha256"] != sha \
+                    and all(entry["sha256"] != previous["sha256"] for entry in index.values()):
+                self._remove_blob(previous["sha256"])
+        return sha
+
+    def _remove_blob(self, sha: str):
+        if os.path.exists(self.blob_path(sha)):
+            os.remove(self.blob_path(sha))
+
+    def touch(self, url: str):
+        with self._lock:
+            index = self._read_index()
+            if url in index:
+                index[url]["used"] = time()
+                self._write_index(index)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the blobs fit in max_bytes,
+        a blob is deleted once no url refers to it. Blobs on disk which are not in the index,
+        eg. left by an interrupted run, are deleted first.
+        :return: list of evicted urls.
+        """
+        evicted = []
+        with self._lock:
+            index = self._read_index()
+            referenced = {entry["sha256"] for entry in index.values()}
+            sizes = dict()
+            for sha in (os.listdir(self.blob_dir) if os.path.isdir(self.blob_dir) else []):
+                if sha in referenced:
+                    sizes[sha] = os.path.getsize(self.blob_path(sha))
+                else:
+                    self._remove_blob(sha)
+            total = sum(sizes.values())
+            for url, entry in sorted(index.items(), key=lambda item: item[1]["used"]):
+                if total <= self.max_bytes:
+                    break
+                del index[url]
+                evicted.append(url)
+                if all(other["sha256"] != entry["sha256"] for other in index.values()):
+                    total -= sizes.get(entry["sha256"], 0)
+                    self._remove_blob(entry["sha256"])
+            if evicted:
+                self._write_index(index)
+        return evicted
+
+    def fetch(self, url: str, save_to: str, connections: int = 4, min_segment_size: int = 1024 * 1024,
+              desc: str = None, session: requests.Session = None, throttle: Throttle = None):
+        """
+        Get the url into save_to from the cache if the server says it is not modified,
+        otherwise download it with resumable_dl and cache it.
+        :param url: download link
+        :param save_to: abs path to save to.
+        :param connections: maximum number of connections for a segmented download, 1 disables it.
+        :param min_segment_size: files smaller than two segments are downloaded over one connection.
+        :param desc: prefix of the progress bar, default is the file name.
+        :param session: requests.Session to reuse connections, default is a new connection.
+        :param throttle: Throttle to cap the bandwidth, default is no cap.
+        :return: save_to
+        """
+        entry = self.entry(url)
+        if entry and self.revalidate(url, entry, session=session):
+            self.touch(url)
+            self.link(entry["sha256"], save_to)
+            return save_to
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        download = os.path.join(self.tmp_dir, sha256(url.encode()).hexdigest())
+        # the validators of the probe the download used, a later probe may describe a newer file.
+        probe = probe_url(url, session=session)
+        resumable_dl(url, download, connections=connections, min_segment_size=min_segment_size,
+                     desc=desc or os.path.basename(save_to), session=session, throttle=throttle, probe=probe)
+        validators = dict(etag=probe["etag"], last_modified=probe["last_modified"])
+        sha = self.add(url, download, validators, filename=os.path.basename(save_to))
+        self.link(sha, save_to)
+        self.evict()
+        return save_to
+
+
+def file_dl(url: str, fdst: str = "Temps", connections: int = 4, min_segment_size: int = 1024 * 1024,
+            session: requests.Session = None, throttle: Throttle = None, cache: DownloadCache = None):
+    """
+    This function download the files from the download link.
+    The download is resumed if a previous download of the same file was interrupted, see resumable_dl.
+    With a cache a file that has not changed on the server is not downloaded again, see DownloadCache.
     :param url: download link
     :param fdst: dst path
-    :return: shutil returns none, if you need data written use f.write().
+    :param connections: maximum number of connections for a segmented download, 1 disables it.
+    :param min_segment_size: files smaller than two segments are downloaded over one connection.
+    :param session: requests.Session to reuse connections, default is a new connection.
+    :param throttle: Throttle to cap the bandwidth, default is no cap.
+    :param cache: DownloadCache, default is no cache.
+    :return: abs path of the downloaded file.
     """
-    filename = get_file_name(url)
-    size = get_file_size(url)
+    entry = cache.entry(url) if cache else None
+    filename = entry["filename"] if entry and entry.get("filename") else get_file_name(url, session=session)
     save_to = set_save_to(filename, subdir=fdst)
-    with requests.get(url, stream=True) as r, open(save_to, "wb") as f, tqdm.wrapattr(
-            r.raw,
-            "read",
-            total=size,
-            unit="B",
-            unit_scale=True,
-            unit_divisor=1024,
-            desc=filename,
-            file=sys.stdout
-    ) as raw:
-        shutil.copyfileobj(raw, f)
+    if cache:
+        return cache.fetch(url, save_to, connections=connections, min_segment_size=min_segment_size, desc=filename,
+                           session=session, throttle=throttle)
+    return resumable_dl(url, save_to, connections=connections, min_segment_size=min_segment_size, desc=filename,
+                        session=session, throttle=throttle)
+
+
+class DownloadManager:
+    """
+    Downloads many urls in threads, downloads are network bound so a process per download is not needed.
+    All downloads share one requests.Session with a connection pool, the number of downloads
+    is limited in total and per host, and the total bandwidth can be capped, see Throttle.
+    """
+
+    def __init__(self, max_workers: int = 8, per_host: int = 2, bandwidth: float = None, connections: int = 4,
+                 cache: DownloadCache = None):
+        """
+        :param max_workers: maximum number of downloads at the same time.
+        :param per_host: maximum number of downloads from the same host at the same time.
+        :param bandwidth: aggregate bytes per second of all downloads, default is no cap.
+        :param connections: connections per download passed to the job, used to size the connection pool.
+        :param cache: DownloadCache passed to the job as cache=, default is no cache.
+        """
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.connections = connections
+        self.throttle = Throttle(bandwidth) if bandwidth else None
+        self.cache = cache
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers,
+                                                pool_maxsize=max(per_host * connections, connections))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _next_url(self, queued, active):
+        """
+        Take the first queued url whose host is below per_host, urls of busy hosts stay queued
+        instead of holding a worker, so other hosts keep all max_workers busy.
+        :param queued: dictionary of host and deque of urls.
+        :param active: dictionary of host and number of running downloads, updated.
+        :return: tuple of host and url, None if no url can start now.
+        """
+        for host, host_urls in queued.items():
+            if host_urls and active.get(host, 0) < self.per_host:
+                active[host] = active.get(host, 0) + 1
+                return host, host_urls.popleft()
+        return None
+
+    def run(self, urls, job=None, **kwargs):
+        """
+        Download every url, the job is called as job(url, session=..., throttle=..., **kwargs),
+        with cache=... as well if the manager has a cache.
+        :param urls: list of download links.
+        :param job: download function, default is file_dl with the manager's connections.
+        :return: generator of (url, result, error) as each download completes,
+        error is None if the job succeeded otherwise result is None.
+        """
+        if job is None:
+            job = file_dl
+            kwargs.setdefault("connections", self.connections)
+        if self.cache is not None:
+            kwargs.setdefault("cache", self.cache)
+        queued = dict()
+        for url in urls:
+            queued.setdefault(urlsplit(url).netloc, deque()).append(url)
+        active = dict()
+        futures = dict()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as e:
+
+            def submit_ready():
+                while len(futures) < self.max_workers:
+                    ready = self._next_url(queued, active)
+                    if ready is None:
+                        return
+                    host, url = ready
+                    futures[e.submit(job, url, session=self.session, throttle=self.throttle, **kwargs)] = (host, url)
+
+            submit_ready()
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                completed = []
+                for future in done:
+                    host, url = futures.pop(future)
+                    active[host] -= 1
+                    completed.append((url, future))
+                # start the next downloads before handing the results to the caller.
+                submit_ready()
+                for url, future in completed:
+                    error = future.exception()
+                    yield url, None if error else future.result(), error
+
+    def report(self, urls, job=None, **kwargs):
+        """
+        Run every download and return the outcome per url.
+        :return: dictionary of url: dict(result=..., error=...)
+        """
+        return {url: dict(result=result, error=error) for url, result, error in self.run(urls, job=job, **kwargs)}
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 if __name__ == "__main__":
@@ -100,5 +783,6 @@ if __name__ == "__main__":
             "https://get.videolan.org/vlc/3.0.11.1/macosx/vlc-3.0.11.1.dmg",
             "https://www.python.org/ftp/python/3.8.5/python-3.8.5-macosx10.9.pkg"]
 
-    with ProcessPoolExecutor() as e:
-        e.map(file_dl, urls)
+    with DownloadManager(max_workers=4, per_host=2, cache=DownloadCache()) as manager:
+        for url, result, error in manager.run(urls):
+            print(f"{url}: {error!r}" if error else f"{url}: {result}")
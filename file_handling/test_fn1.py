@@ -1,60 +1,37 @@
 import os
-import sys
-import requests
 from pathlib import Path
-from tqdm import tqdm
-from concurrent.futures import ProcessPoolExecutor
-import shutil
+from dl_fn1 import probe_url, resumable_dl, DownloadManager, DownloadCache
 
 # Download file with tqdm for progress bar and shutil.copyfileobj for copying the requests stream.
 
-def get_filename(url):
-    filename = os.path.basename(url)
-    fname, extension = os.path.splitext(filename)
-    if extension:
-        return filename
-    header = requests.head(url).headers
-    if "Location" in header:
-        return os.path.basename(header["Location"])
-    return fname
+def get_filename(url, session=None):
+    return probe_url(url, session=session)["filename"]
 
 
-def get_file_size(url):
-    header = requests.head(url).headers
-    if "Content-Length" in header and header["Content-Length"] != 0:
-        return int(header["Content-Length"])
-    elif "Location" in header and "status" not in header:
-        redirect_link = header["Location"]
-        r = requests.head(redirect_link).headers
-        return int(r["Content-Length"])
+def get_file_size(url, session=None):
+    return probe_url(url, session=session)["size"]
 
 
-def download_file(url, filename=None):
+def download_file(url, filename=None, session=None, throttle=None, cache=None):
     # Download to the Downloads folder in user's home folder.
+    # An interrupted download is resumed from the .part file on the next call, see dl_fn1.resumable_dl.
     download_dir = os.path.join(Path.home(), "Downloads")
     if not os.path.exists(download_dir):
         os.makedirs(download_dir, exist_ok=True)
     if not filename:
-        filename = get_filename(url)
-    file_size = get_file_size(url)
+        filename = get_filename(url, session=session)
     abs_path = os.path.join(download_dir, filename)
-    chunk_size = 1024
-    with open(abs_path, "wb") as f, requests.get(url, stream=True) as r, tqdm.wrapattr(
-            r.raw,
-            "read",
-            unit="B",
-            unit_scale=True,
-            unit_divisor=chunk_size,
-            desc=filename,
-            total=file_size,
-            file=sys.stdout
-    ) as raw:
-        shutil.copyfileobj(raw, f)
+    if cache:
+        # unchanged files are linked from the cache, see dl_fn1.DownloadCache.
+        return cache.fetch(url, abs_path, connections=1, desc=filename, session=session, throttle=throttle)
+    return resumable_dl(url, abs_path, connections=1, desc=filename,
+                        session=session, throttle=throttle)
 
 
 if __name__ == "__main__":
     urls = ["http://mirrors.evowise.com/linuxmint/stable/20/linuxmint-20-xfce-64bit.iso",
             "https://www.vmware.com/go/getworkstation-win",
             "https://download.geany.org/geany-1.36_setup.exe"]
-    with ProcessPoolExecutor() as e:
-        e.map(download_file, urls, timeout=60)
+    with DownloadManager(max_workers=3, cache=DownloadCache()) as manager:
+        for url, result in manager.report(urls, job=download_file).items():
+            print(f"{url}: {result['error']!r}" if result["error"] else f"{url}: {result['result']}")
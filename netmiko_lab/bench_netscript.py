@@ -0,0 +1,138 @@
+import argparse
+import json
+from statistics import mean, median
+from time import perf_counter
+from fake_ios import FakeIOS, FakeIOSFleet
+from netscript import CiscoIOS, SessionPool, ShowCache, config_template, precompile_templates, show_cache
+from net1 import run_fleet, get_interface_brief, update_router_interface_status, refresh_collection
+
+# Benchmarks of netscript and net1 against fake routers from fake_ios, no real router is needed.
+# Usage:
+# python bench_netscript.py --devices 1 10 100 --latency-save 0.5
+# python bench_netscript.py --mongo-url mongodb://127.0.0.1:27017 --json bench.json
+
+INTF_CONFIG = dict(intf_id="loopback4", ipaddr="4.4.4.4", up=True)
+OSPF_CONFIG = dict(process_id=1, router_id="1.1.1.1", intf_id="Ethernet0/0", ipv4_addr="10.0.0.1",
+                   netmask="255.255.255.252", area_id=0, lo_id=1)
+
+
+def timeit(fn, repeat=5):
+    """
+    Run fn repeat times.
+    :param fn: function without arguments.
+    :return: dictionary of min, median and mean seconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        timings.append(perf_counter() - start)
+    return dict(min=min(timings), median=median(timings), mean=mean(timings))
+
+
+def router_for(device_config, pool, **kwargs):
+    return CiscoIOS(ip=device_config["ip"], port=device_config["port"], username=device_config["username"],
+                    password=device_config["password"], secret=device_config["secret"], pool=pool,
+                    cache=ShowCache(ttl=0), **kwargs)
+
+
+def bench_operations(latency, repeat):
+    """
+    Latency of single operations against one fake router.
+    """
+    results = dict()
+    with FakeIOS(latency=latency) as device:
+        device_config = device.device_config()
+        results["connect+show (get_interface_brief)"] = timeit(lambda: get_interface_brief(**device_config),
+                                                               repeat)
+        pool = SessionPool()
+        router = router_for(device_config, pool)
+        router.show_version()
+        results["show_intf_brief (pooled session)"] = timeit(router.show_intf_brief, repeat)
+        results["set_intf (pooled session)"] = timeit(lambda: router.set_intf(**INTF_CONFIG), repeat)
+
+        def transaction():
+            with router.transaction():
+                router.set_intf(**INTF_CONFIG)
+                router.set_ospf(**OSPF_CONFIG)
+                router.set_hostname(device.hostname)
+
+        results["transaction of 3 changes"] = timeit(transaction, repeat)
+        delta_router = router_for(device_config, pool, minimal_delta=True)
+        results["set_ospf no-op (minimal_delta)"] = timeit(lambda: delta_router.set_ospf(**OSPF_CONFIG), repeat)
+        pool.close()
+    return results
+
+
+def bench_templates(repeat):
+    precompile_templates()
+    template = config_template(template_file="named_acl_extended.j2")
+    rule = dict(acl_name="BENCH", action="permit", proto="tcp", src_net="10.0.0.0", src_wildcard="0.0.0.255",
+                dst_host="192.168.1.1", eq=443)
+    return {"render 1000 acl entries": timeit(lambda: [template.render(**rule) for _ in range(1000)], repeat)}
+
+
+def bench_fleet(count, latency, workers):
+    """
+    Throughput of a show and a config job across count fake routers.
+    """
+    results = dict()
+    with FakeIOSFleet(count, latency=latency) as fleet:
+        device_configs = fleet.device_configs()
+        for name, job, kwargs in (("get_interface_brief", get_interface_brief, {}),
+                                  ("set_intf", "set_intf", INTF_CONFIG)):
+            start = perf_counter()
+            errors = sum(1 for _, _, error in run_fleet(job, device_configs, max_workers=workers, **kwargs)
+                         if error is not None)
+            elapsed = perf_counter() - start
+            results[f"{name} x{count}"] = dict(seconds=elapsed, devices_per_second=count / elapsed, errors=errors)
+    return results
+
+
+def bench_mongo(mongo_url, interfaces, repeat):
+    from pymongo import MongoClient
+    collection = MongoClient(mongo_url)["bench"]["interfaces"]
+    rows = [dict(intf=f"Ethernet0/0.{number}", ipaddr=f"10.{number // 256 % 256}.{number % 256}.1",
+                 status="up", proto="up") for number in range(interfaces)]
+    refresh_collection(collection, [dict(row) for row in rows])
+    changed = [dict(row, status="down") if number % 10 == 0 else dict(row) for number, row in enumerate(rows)]
+    results = {
+        f"update_router_interface_status {interfaces} intf, no change":
+            timeit(lambda: update_router_interface_status(collection, rows), repeat),
+        f"refresh_collection staged {interfaces} intf":
+            timeit(lambda: refresh_collection(collection, [dict(row) for row in changed], mode="staged"), repeat),
+    }
+    collection.drop()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark netscript and net1 against fake ios routers.")
+    parser.add_argument("--devices", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--latency-command", type=float, default=0.0)
+    parser.add_argument("--latency-config", type=float, default=0.0)
+    parser.add_argument("--latency-save", type=float, default=0.0)
+    parser.add_argument("--mongo-url", help="also benchmark the mongodb functions, eg. mongodb://127.0.0.1:27017")
+    parser.add_argument("--interfaces", type=int, default=2000)
+    parser.add_argument("--json", help="write the results to this file.")
+    args = parser.parse_args()
+
+    # every call must reach the fake router.
+    show_cache.ttl = 0
+    latency = dict(command=args.latency_command, config=args.latency_config, save=args.latency_save)
+    report = dict()
+    report.update(bench_operations(latency, args.repeat))
+    report.update(bench_templates(args.repeat))
+    for count in args.devices:
+        report.update(bench_fleet(count, latency, args.workers))
+    if args.mongo_url:
+        report.update(bench_mongo(args.mongo_url, args.interfaces, args.repeat))
+
+    for name, result in report.items():
+        print(f"{name:<50}" + "  ".join(f"{key}={value:.4f}" if isinstance(value, float) else f"{key}={value}"
+                                       for key, value in result.items()))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
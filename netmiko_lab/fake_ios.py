@@ -0,0 +1,501 @@
+import hashlib
+import logging
+import socket
+import threading
+from time import sleep
+import paramiko
+
+# A local stand-in for cisco ios routers, good enough for netmiko and netscript.CiscoIOS.
+# It emulates the exec, enable and config mode prompts, show ip int brief, show running-config,
+# show version and write memory, each with a configurable latency in seconds.
+# Files can be uploaded to flash: with scp and merged with copy flash:/<file> running-config.
+# Usage:
+# with FakeIOSFleet(10, latency={"save": 2}) as fleet:
+#     for device_config in fleet.device_configs():
+#         print(get_interface_brief(**device_config))
+
+# The server side transports log every client which disconnects without closing the session.
+logging.getLogger("fake_ios.transport").setLevel(logging.CRITICAL)
+
+_host_key = None
+_host_key_lock = threading.Lock()
+
+
+def host_key():
+    """
+    One rsa key for all fake routers, generating a key is slow.
+    :return: paramiko.RSAKey
+    """
+    global _host_key
+    with _host_key_lock:
+        if _host_key is None:
+            _host_key = paramiko.RSAKey.generate(2048)
+        return _host_key
+
+
+# Sub mode prompt of the commands which enter a configuration section.
+_SUB_MODES = {
+    "interface ": "config-if",
+    "router ": "config-router",
+    "ip access-list extended ": "config-ext-nacl",
+    "ip access-list standard ": "config-std-nacl",
+    "line ": "config-line",
+}
+
+_INTF_BRIEF_HEADER = "Interface                  IP-Address      OK? Method Status                Protocol"
+
+
+class _Server(paramiko.ServerInterface):
+
+    def __init__(self, device):
+        self.device = device
+        self.requested = threading.Event()
+        self.exec_command = None
+
+    def check_auth_password(self, username, password):
+        if username == self.device.username and password == self.device.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        self.requested.set()
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        # only scp uploads are supported.
+        if not command.decode().startswith("scp -t "):
+            return False
+        self.exec_command = command.decode()
+        self.requested.set()
+        return True
+
+
+class FakeIOS:
+    """
+    One fake router listening on 127.0.0.1, every ssh session shares the router's configuration.
+    """
+
+    def __init__(self, hostname="R1", host="127.0.0.1", port=0, username="admin", password="password",
+                 secret="secret", latency=None):
+        """
+        :param hostname: hostname shown in the prompt.
+        :param host: address to listen on.
+        :param port: port to listen on, 0 picks a free port.
+        :param username: username of router
+        :param password: password of router
+        :param secret: enable password of router.
+        :param latency: dictionary of seconds to wait, keys are connect, command, config and save.
+        """
+        self.hostname = hostname
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.secret = secret
+        self.latency = dict(connect=0, command=0, config=0, save=0)
+        self.latency.update(latency or {})
+        self.saves = 0
+        self.config_lines = 0
+        self.files = dict()
+        self.sections = {
+            "interface Ethernet0/0": ["ip address 10.0.0.1 255.255.255.252"],
+            "interface Ethernet0/1": ["no ip address", "shutdown"],
+        }
+        self.lock = threading.Lock()
+        self._sock = None
+        self._running = False
+
+    def start(self):
+        """
+        Listen and accept ssh sessions in a background thread.
+        :return: this FakeIOS object.
+        """
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self.host, self.port))
+        self.port = self._sock.getsockname()[1]
+        self._sock.listen(100)
+        self._running = True
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._running = False
+        try:
+            self._sock.close()
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def device_config(self):
+        """
+        :return: device config for netmiko ConnectHandler, same format as net1.get_device_config.
+        """
+        return dict(device_type="cisco_ios", ip=self.host, port=self.port,
+                    username=self.username, password=self.password, secret=self.secret)
+
+    def _accept(self):
+        while self._running:
+            try:
+                client, _ = self._sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, client):
+        transport = paramiko.Transport(client)
+        transport.set_log_channel("fake_ios.transport")
+        transport.add_server_key(host_key())
+        server = _Server(self)
+        try:
+            transport.start_server(server=server)
+            channel = transport.accept(20)
+            if channel is None:
+                return
+            self._handle_channel(channel, server)
+            # let the client close the connection, closing it here resets the client's socket.
+            for _ in range(50):
+                if not transport.is_active():
+                    break
+                sleep(0.1)
+        except (EOFError, OSError, paramiko.SSHException):
+            pass
+        finally:
+            transport.close()
+
+    def _handle_channel(self, channel, server):
+        server.requested.wait(10)
+        if server.exec_command is not None:
+            self._scp_sink(channel, server.exec_command.split()[-1])
+            return
+        sleep(self.latency["connect"])
+        _Shell(self, channel).run()
+
+    def _scp_sink(self, channel, destination):
+        """
+        Receive files with the scp protocol, eg. scp -t flash:/acl.cfg
+        """
+        reader = channel.makefile("rb")
+        channel.sendall(b"\0")
+        while True:
+            header = reader.readline()
+            if not header:
+                break
+            if header.startswith(b"C"):
+                _, size, name = header.decode().rstrip("\n").split(" ", 2)
+                channel.sendall(b"\0")
+                data = reader.read(int(size))
+                reader.read(1)
+                path = destination.split(":", 1)[-1].lstrip("/") or name
+                with self.lock:
+                    self.files[path] = data
+            channel.sendall(b"\0")
+        channel.send_exit_status(0)
+        channel.close()
+
+    def merge_config(self, config):
+        """
+        Apply the configuration file to the running-config like copy flash:/file running-config.
+        :param config: configuration commands, one per line.
+        :return: number of commands applied.
+        """
+        section = None
+        count = 0
+        for line in config.splitlines():
+            command = " ".join(line.split())
+            if not command or command.startswith("!"):
+                continue
+            if command in ("end", "exit"):
+                section = None
+                continue
+            section = self.configure(section, command)
+            count += 1
+        return count
+
+    def running_config(self):
+        lines = ["Building configuration...", "", "Current configuration : 1024 bytes", "!",
+                 f"hostname {self.hostname}", "!"]
+        with self.lock:
+            for header, children in self.sections.items():
+                lines.append(header)
+                lines.extend(f" {child}" for child in children)
+                lines.append("!")
+        lines.append("end")
+        return "\r\n".join(lines)
+
+    def interface_brief(self):
+        lines = [_INTF_BRIEF_HEADER]
+        with self.lock:
+            for header, children in self.sections.items():
+                if not header.startswith("interface "):
+                    continue
+                ipaddr = next((child.split()[2] for child in children if child.startswith("ip address ")),
+                              "unassigned")
+                status = "administratively down" if "shutdown" in children else "up"
+                proto = "down" if "shutdown" in children else "up"
+                method = "manual" if ipaddr != "unassigned" else "unset"
+                lines.append(f"{header[10:]:<27}{ipaddr:<16}YES {method:<7}{status:<22}{proto}")
+        return "\r\n".join(lines)
+
+    def configure(self, section, command):
+        """
+        Apply one configuration command.
+        :param section: current section header, None in global config mode.
+        :param command: configuration command.
+        :return: section header after the command.
+        """
+        with self.lock:
+            self.config_lines += 1
+            if command.startswith("hostname "):
+                self.hostname = command.split(" ", 1)[1]
+                return None
+            if command.startswith("no interface "):
+                self.sections.pop(_normalize_header(command[3:]), None)
+                return None
+            if command.startswith("default interface "):
+                self.sections[_normalize_header(command[8:])] = []
+                return None
+            if command.startswith(tuple(_SUB_MODES)):
+                section = _normalize_header(command)
+                self.sections.setdefault(section, [])
+                return section
+            if section is None:
+                return None
+            children = self.sections.setdefault(section, [])
+            if command.startswith("no "):
+                negated = command[3:]
+                children[:] = [child for child in children
+                               if child != negated and not child.startswith(negated + " ")]
+                # ios only shows these negated commands in the running-config.
+                if command != "no ip address" and (not command.startswith("no passive-interface ")
+                                                   or command == "no passive-interface default"):
+                    return section
+            elif command.startswith("ip address "):
+                children[:] = [child for child in children if not child.startswith(("ip address", "no ip address"))]
+            if command not in children:
+                children.append(command)
+            return section
+
+
+def _normalize_header(header):
+    # ios shows loopback4 as Loopback4 in the running-config.
+    if header.startswith("interface "):
+        name = header[10:]
+        return f"interface {name[0].upper()}{name[1:]}"
+    return header
+
+
+class _Shell:
+    """
+    Line based emulation of the ios cli on one ssh channel.
+    """
+
+    def __init__(self, device, channel):
+        self.device = device
+        self.channel = channel
+        self.mode = "exec"
+        self.section = None
+        self.enabled = False
+        self.awaiting_secret = False
+        self.awaiting_confirm = None
+
+    def prompt(self):
+        if self.mode == "exec":
+            return f"{self.device.hostname}{'#' if self.enabled else '>'}"
+        if self.section is None:
+            return f"{self.device.hostname}(config)#"
+        sub_mode = next(mode for start, mode in _SUB_MODES.items() if self.section.startswith(start))
+        return f"{self.device.hostname}({sub_mode})#"
+
+    def send(self, text):
+        self.channel.sendall(text.encode())
+
+    def run(self):
+        self.send(f"\r\n{self.prompt()}")
+        buffer = b""
+        while True:
+            data = self.channel.recv(65536)
+            if not data:
+                return
+            buffer += data
+            while True:
+                positions = [position for position in (buffer.find(b"\r"), buffer.find(b"\n")) if position >= 0]
+                if not positions:
+                    break
+                end = min(positions)
+                line = buffer[:end].decode(errors="ignore")
+                skip = 2 if buffer[end:end + 2] == b"\r\n" else 1
+                buffer = buffer[end + skip:]
+                self.handle(line)
+
+    def handle(self, line):
+        if self.awaiting_secret:
+            self.awaiting_secret = False
+            if line == self.device.secret:
+                self.enabled = True
+                self.send(f"\r\n{self.prompt()}")
+            else:
+                self.send(f"\r\n% Access denied\r\n\r\n{self.prompt()}")
+            return
+        self.send(f"{line}\r\n")
+        command = " ".join(line.split())
+        if self.awaiting_confirm is not None:
+            confirm, self.awaiting_confirm = self.awaiting_confirm, None
+            output = confirm(command)
+        elif self.mode == "config":
+            output = self.config_command(command)
+        else:
+            output = self.exec_command(command)
+        if output is None:
+            return
+        self.send(f"{output}\r\n{self.prompt()}" if output else self.prompt())
+
+    def exec_command(self, command):
+        if not command:
+            return ""
+        if command.startswith(("terminal ", "term ")):
+            return ""
+        if command in ("enable", "en"):
+            if self.enabled:
+                return ""
+            self.awaiting_secret = True
+            self.send("Password: ")
+            return None
+        if command == "disable":
+            self.enabled = False
+            return ""
+        if command in ("exit", "quit", "logout"):
+            self.channel.close()
+            return None
+        sleep(self.device.latency["command"])
+        if command in ("show ip int brief", "show ip interface brief"):
+            return self.device.interface_brief()
+        if command == "show version":
+            return (f"Cisco IOS Software, Linux Software (I86BI_LINUX-ADVENTERPRISEK9-M), Version 15.5(2)T\r\n"
+                    f"{self.device.hostname} uptime is 1 hour, 2 minutes\r\n"
+                    f"Configuration register is 0x0")
+        if not self.enabled:
+            return "                  ^\r\n% Invalid input detected at '^' marker.\r\n"
+        if command in ("configure terminal", "conf t", "config term"):
+            self.mode = "config"
+            self.section = None
+            return "Enter configuration commands, one per line.  End with CNTL/Z."
+        if command.startswith(("show running-config", "show run")):
+            return self.device.running_config()
+        if command in ("write mem", "write memory", "wr", "copy running-config startup-config"):
+            sleep(self.device.latency["save"])
+            with self.device.lock:
+                self.device.saves += 1
+            return "Building configuration...\r\n[OK]"
+        if command.startswith(("dir ", "verify ", "copy flash:", "delete ")):
+            return self.flash_command(command)
+        return "                  ^\r\n% Invalid input detected at '^' marker.\r\n"
+
+    def flash_command(self, command):
+        name = command.split()[-1].split(":", 1)[-1].lstrip("/")
+        if command.startswith("copy "):
+            name = command.split()[1].split(":", 1)[-1].lstrip("/")
+        with self.device.lock:
+            data = self.device.files.get(name)
+        if command.startswith("dir ") and not name:
+            return ("Directory of flash:/\r\n\r\n"
+                    + "".join(f"    1  -rw-  {len(content)}  Oct 18 2026 00:00:00 +00:00  {file}\r\n"
+                              for file, content in self.device.files.items())
+                    + "\r\n1000000000 bytes total (900000000 bytes free)")
+        if data is None:
+            return f"%Error opening flash:/{name} (No such file or directory)"
+        if command.startswith("dir "):
+            return (f"Directory of flash:/{name}\r\n\r\n"
+                    f"    1  -rw-  {len(data)}  Oct 18 2026 00:00:00 +00:00  {name}\r\n\r\n"
+                    f"1000000000 bytes total (900000000 bytes free)")
+        if command.startswith("verify "):
+            return f".MD5 of flash:/{name} Done!\r\nverify /md5 (flash:/{name}) = {hashlib.md5(data).hexdigest()}"
+        if command.startswith("delete "):
+            with self.device.lock:
+                self.device.files.pop(name, None)
+            return ""
+
+        def merge(answer):
+            sleep(self.device.latency["command"])
+            self.device.merge_config(data.decode())
+            return f"{len(data)} bytes copied in 0.100 secs ({len(data) * 10} bytes/sec)"
+
+        self.awaiting_confirm = merge
+        self.send("Destination filename [running-config]? ")
+        return None
+
+    def config_command(self, command):
+        if not command:
+            return ""
+        if command == "end":
+            self.mode = "exec"
+            self.section = None
+            return ""
+        if command == "exit":
+            if self.section is None:
+                self.mode = "exec"
+            self.section = None
+            return ""
+        sleep(self.device.latency["config"])
+        self.section = self.device.configure(self.section, command)
+        return ""
+
+
+class FakeIOSFleet:
+    """
+    Many fake routers, each one listening on its own port.
+    """
+
+    def __init__(self, count, **kwargs):
+        """
+        :param count: number of fake routers, the hostnames are R1 to R<count>.
+        :param kwargs: arguments for FakeIOS such as latency.
+        """
+        self.devices = [FakeIOS(hostname=f"R{number}", **kwargs) for number in range(1, count + 1)]
+
+    def start(self):
+        host_key()
+        for device in self.devices:
+            device.start()
+        return self
+
+    def stop(self):
+        for device in self.devices:
+            device.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def device_configs(self):
+        return [device.device_config() for device in self.devices]
+
+
+if __name__ == "__main__":
+    # Run one fake router in the foreground, eg. to try netscript.CiscoIOS against it.
+    router = FakeIOS(port=2222).start()
+    print(f"Fake router {router.hostname} listening on {router.host}:{router.port}, "
+          f"username {router.username} password {router.password} secret {router.secret}")
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        router.stop()
@@ -1,16 +1,22 @@
-from netmiko import ConnectHandler
-from pymongo import MongoClient
-from jinja2 import Environment, FileSystemLoader
+from pymongo import InsertOne, UpdateOne, DeleteOne, ASCENDING, DESCENDING
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from inspect import signature, Parameter
+from time import monotonic
+from datetime import datetime, timezone
+import hashlib
+import json
+import os
+from netscript import CiscoIOS, template_env, precompile_templates, mongodb_client, device_inventory, show_cache
+from netscript import connect_device, check_reachable, circuit_breaker, DeviceUnavailable, invalidate_running_config
 
 
 def init_j2_template(template_dir):
     """
-    Initialize jinja2 template
+    Initialize jinja2 template, the environment is shared so templates are compiled once.
     :param template_dir: j2 template location
     :return: Environment object
     """
-    file_loader = FileSystemLoader(template_dir)
-    return Environment(loader=file_loader)
+    return template_env(template_dir)
 
 
 def get_device_config(mongo_url="mongodb://192.168.1.245:27017",
@@ -25,8 +31,23 @@ def get_device_config(mongo_url="mongodb://192.168.1.245:27017",
     :param ip: mgmt ip address of cisco router
     :return: device configuration in dictionary.
     """
-    client = MongoClient(mongo_url)
-    return client[dbname][table_name].find_one({"ip": ip}, {"_id": 0})
+    return device_inventory(mongo_url, dbname, table_name).get(ip)
+
+
+def get_devices_config(mongo_url="mongodb://192.168.1.245:27017",
+                       dbname="testdb",
+                       table_name="testtbl",
+                       ips=None):
+    """
+    Get many cisco routers' device config with one query, suitable for run_fleet.
+    :param mongo_url: mongodb address
+    :param dbname: database name
+    :param table_name: collection name
+    :param ips: list of mgmt ip address of cisco routers
+    :return: list of device configuration in dictionary, devices not found are left out.
+    """
+    devices = device_inventory(mongo_url, dbname, table_name).get_many(ips or [])
+    return [devices[ip] for ip in ips or [] if devices[ip] is not None]
 
 
 def config_ospf(netmiko_connector, j2env, **ospf_config):
@@ -72,7 +93,7 @@ def config_router(device_config, config_what=None, **router_config):
     :param router_config: router configuration in dictionary
     :return: None
     """
-    with ConnectHandler(**device_config) as conn:
+    with connect_device(**device_config) as conn:
         env = init_j2_template("templates")
         # need to enter enable mode because send_config_set does not do enable.
         enable_mode(conn)
@@ -88,65 +109,514 @@ def config_router(device_config, config_what=None, **router_config):
                 print(conn.send_config_set([f"no interface {remove_what[-1]}"]))
         # save configuration (write memory)
         conn.save_config()
+    show_cache.invalidate(device_config)
+    invalidate_running_config(device_config)
+
+
+def _plan_file(device):
+    return device.replace(os.sep, "_").replace(":", "_") + ".cfg"
+
+
+def _render_device_plan(task):
+    """
+    Render all the templates of one device and write the plan file, runs in a worker process.
+    :param task: tuple of (device, list of (template, config), template_dir, plan_dir)
+    :return: tuple of (device, plan file name, sha256 of the plan, number of commands)
+    """
+    device, entries, template_dir, plan_dir = task
+    env = init_j2_template(template_dir)
+    commands = []
+    for template, config in entries:
+        rendered = env.get_template(template).render(**config)
+        commands.extend(line.strip() for line in rendered.splitlines() if line.strip())
+    plan = "\n".join(commands) + "\n"
+    filename = _plan_file(device)
+    with open(os.path.join(plan_dir, filename), "w") as f:
+        f.write(plan)
+    return device, filename, hashlib.sha256(plan.encode()).hexdigest(), len(commands)
+
+
+def render_plan(topology, plan_dir="plans", template_dir="templates", max_workers=None, chunksize=64):
+    """
+    Render the configuration of every device in the topology ahead of time with a pool of processes,
+    write one plan file per device and plan.json with the sha256 of every plan and of the whole plan.
+    The plan can be reviewed before push_plan sends it to the devices.
+    :param topology: list of dictionary eg. {"device": "192.168.1.215", "template": "ospf.j2", "config": {...}},
+    a device can have many entries, they are rendered in order.
+    :param plan_dir: directory to write the plan to.
+    :param template_dir: j2 template location
+    :param max_workers: number of processes, default is number of cpus.
+    :param chunksize: number of devices sent to a worker process at a time.
+    :return: the plan.json content in dictionary.
+    """
+    os.makedirs(plan_dir, exist_ok=True)
+    devices = dict()
+    for entry in topology:
+        devices.setdefault(entry["device"], []).append((entry["template"], entry.get("config", {})))
+    tasks = [(device, entries, os.path.abspath(template_dir), os.path.abspath(plan_dir))
+             for device, entries in devices.items()]
+    precompile_templates(template_dir)
+    manifest = dict(created=datetime.now(timezone.utc).isoformat(), devices=dict())
+    with ProcessPoolExecutor(max_workers=max_workers) as e:
+        for device, filename, digest, count in e.map(_render_device_plan, tasks, chunksize=chunksize):
+            manifest["devices"][device] = dict(file=filename, sha256=digest, commands=count)
+    manifest["digest"] = hashlib.sha256("".join(
+        f"{device}:{plan['sha256']}\n" for device, plan in sorted(manifest["devices"].items())).encode()).hexdigest()
+    with open(os.path.join(plan_dir, "plan.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def load_plan(plan_dir, device):
+    """
+    Read the planned commands of the device, the plan file must match the sha256 in plan.json.
+    :param plan_dir: directory of the plan.
+    :param device: device in the topology, eg. ip address.
+    :return: list of configuration commands.
+    """
+    with open(os.path.join(plan_dir, "plan.json")) as f:
+        planned = json.load(f)["devices"].get(device)
+    if planned is None:
+        raise KeyError(f"{device} is not in the plan {plan_dir}.")
+    with open(os.path.join(plan_dir, planned["file"]), "rb") as f:
+        plan = f.read()
+    if hashlib.sha256(plan).hexdigest() != planned["sha256"]:
+        raise ValueError(f"The plan of {device} was changed after it was rendered.")
+    return plan.decode().splitlines()
+
+
+def push_plan(device_config, plan_dir="plans"):
+    """
+    Send the precomputed plan of the device, no template is rendered in the ssh session.
+    Can be used with run_fleet eg. run_fleet(push_plan, device_configs, plan_dir="plans")
+    :param device_config: device info for netmiko connecthandler, the plan is looked up by ip.
+    :param plan_dir: directory of the plan.
+    :return: output of the commands.
+    """
+    commands = load_plan(plan_dir, device_config["ip"])
+    with connect_device(**device_config) as conn:
+        enable_mode(conn)
+        output = conn.send_config_set(commands)
+        conn.save_config()
+    show_cache.invalidate(device_config)
+    invalidate_running_config(device_config)
+    return output
+
+
+def _up_up(row):
+    return row.get("status") == "up" and row.get("proto") == "up"
+
+
+def interface_changes(db_rows, interface_result, key_filter=None, up_up=False):
+    """
+    Compare the interfaces in mongodb with the interfaces from the router by intf,
+    and build the write operations for the interfaces which are new, changed or removed.
+    Only the ipaddr, status and proto columns which differ are set.
+    :param db_rows: documents from mongodb, must include intf.
+    :param interface_result: result of show ip int brief.
+    :param key_filter: optional, extra fields which identify the documents eg. {"device": "R1"}
+    :param up_up: keep the derived up_up column (True if status and proto are up) in sync,
+    used by the fleet wide collection so that interfaces_down can use an index.
+    :return: tuple of list of write operations and dictionary of counts.
+    """
+    key_filter = key_filter or dict()
+    current = {row["intf"]: row for row in db_rows}
+    operations = []
+    counts = dict(inserted=0, updated=0, removed=0)
+    seen = set()
+    for row in interface_result:
+        intf = row["intf"]
+        seen.add(intf)
+        db_row = current.get(intf)
+        if db_row is None:
+            operations.append(InsertOne({**key_filter, **row, **({"up_up": _up_up(row)} if up_up else {})}))
+            counts["inserted"] += 1
+            continue
+        changed = {field: row[field] for field in ("ipaddr", "status", "proto")
+                   if db_row.get(field) != row.get(field)}
+        if up_up and db_row.get("up_up") != _up_up(row):
+            changed["up_up"] = _up_up(row)
+        if changed:
+            operations.append(UpdateOne({**key_filter, "intf": intf}, {"$set": changed}))
+            counts["updated"] += 1
+    for intf in current.keys() - seen:
+        operations.append(DeleteOne({**key_filter, "intf": intf}))
+        counts["removed"] += 1
+    return operations, counts
 
 
 def update_router_interface_status(mongodb_table, interface_result):
     """
     This updates the interface status table, the _id and intf columns do not change.
-    This function is to update the ipaddr, status and proto columns.
-    The function compares mongodb_table and result of interface_result, if mongodb_table
-    differs from interface_result then updates the mongodb_table.
+    The rows are matched by intf, only the ipaddr, status and proto columns which differ
+    are updated, interfaces new on the router are inserted and interfaces no longer on
+    the router are removed. All the changes are sent in one ordered bulk_write.
     :param mongodb_table:
     :param interface_result:
-    :return:
+    :return: dictionary of the number of inserted, updated and removed interfaces.
     """
-    for db_row in mongodb_table.find({}, {"_id": 0}):
-        for row in interface_result:
-            if db_row["ipaddr"] != row["ipaddr"]:
-                mongodb_table.update_one({"intf": row["intf"]}, {"$set": {"ipaddr": row["ipaddr"]}})
-            if db_row["status"] != row["status"]:
-                mongodb_table.update_one({"intf": row["intf"]}, {"$set": {"status": row["status"]}})
-            if db_row["proto"] != row["proto"]:
-                mongodb_table.update_one({"intf": row["intf"]}, {"$set": {"proto": row["proto"]}})
+    db_rows = mongodb_table.find({}, {"_id": 0, "intf": 1, "ipaddr": 1, "status": 1, "proto": 1})
+    operations, counts = interface_changes(db_rows, interface_result)
+    if operations:
+        mongodb_table.bulk_write(operations, ordered=True)
+    return counts
 
 
-def refresh_collection(collection, interface_result):
+def refresh_collection(collection, interface_result, mode="drop"):
     """
-    This function refresh the collection, by dropping existing collection.
-    if collection is new it is created in the collection argument, the documents
-    are inserted anyway. The drop method will not throw exception even if the
-    collection does not exist.
-    This is very straight forward drop the table and insert updated on from router.
+    This function refresh the collection with the interface_result from router.
+    drop mode: drop existing collection and insert the documents. The drop method will not
+    throw exception even if the collection does not exist, but readers see an empty
+    collection until the insert completes.
+    staged mode: insert the documents into a staging collection then rename the staging
+    collection over the collection, the rename replaces the collection atomically.
+    incremental mode: only write the interfaces which are new, changed or removed,
+    see update_router_interface_status.
     :param collection:
     :param interface_result:
-    :return:
+    :param mode: drop, staged or incremental.
+    :return: dictionary of counts for incremental mode, else None.
     """
+    if mode == "incremental":
+        return update_router_interface_status(collection, interface_result)
+    if mode == "staged":
+        if not interface_result:
+            collection.drop()
+            return
+        staging = collection.database[f"{collection.name}_staging"]
+        staging.drop()
+        staging.insert_many(interface_result)
+        staging.rename(collection.name, dropTarget=True)
+        return
+    if mode != "drop":
+        raise ValueError(f"Unknown refresh mode {mode}, use drop, staged or incremental.")
     collection.drop()
     collection.insert_many(interface_result)
 
 
+def ensure_fleet_indexes(collection):
+    """
+    Create the indexes of the fleet wide interface collection, one document per device and intf.
+    :param collection: fleet wide interface collection eg. client["network"]["interfaces"]
+    :return:
+    """
+    collection.create_index([("device", ASCENDING), ("intf", ASCENDING)], unique=True)
+    # interfaces_down, a $or of status and proto not up cannot be served by an index, so it queries up_up.
+    collection.create_index([("up_up", ASCENDING), ("device", ASCENDING)])
+
+
+def refresh_fleet_interfaces(collection, device, interface_result):
+    """
+    Update the interfaces of one router in the fleet wide interface collection,
+    only the new, changed and removed interfaces are written in one bulk_write.
+    :param collection: fleet wide interface collection.
+    :param device: name of the router eg. R1
+    :param interface_result: result of show ip int brief.
+    :return: dictionary of the number of inserted, updated and removed interfaces.
+    """
+    db_rows = collection.find({"device": device},
+                              {"_id": 0, "intf": 1, "ipaddr": 1, "status": 1, "proto": 1, "up_up": 1})
+    operations, counts = interface_changes(db_rows, interface_result, key_filter={"device": device}, up_up=True)
+    if operations:
+        collection.bulk_write(operations, ordered=True)
+    return counts
+
+
+def migrate_per_router_collections(db, target="interfaces", names=None, batch_size=1000):
+    """
+    Copy the per router collections eg. network.R1, network.R2 into the fleet wide collection,
+    the collection name becomes the device field. The per router collections are not dropped.
+    :param db: mongodb database eg. client["network"]
+    :param target: name of the fleet wide interface collection.
+    :param names: optional, list of per router collection names, default is every collection
+    except the target, devices, interface_events and staging collections.
+    :param batch_size: number of documents per bulk_write.
+    :return: dictionary of collection name and number of interfaces copied.
+    """
+    collection = db[target]
+    ensure_fleet_indexes(collection)
+    if names is None:
+        names = [name for name in db.list_collection_names()
+                 if name not in (target, "devices", "interface_events")
+                 and not name.endswith(("_staging", "_latest"))]
+    migrated = dict()
+    for name in names:
+        operations = []
+        migrated[name] = 0
+        for row in db[name].find({"intf": {"$exists": True}}, {"_id": 0}):
+            operations.append(UpdateOne({"device": name, "intf": row["intf"]},
+                                        {"$set": {**row, "device": name, "up_up": _up_up(row)}}, upsert=True))
+            if len(operations) >= batch_size:
+                collection.bulk_write(operations, ordered=False)
+                migrated[name] += len(operations)
+                operations = []
+        if operations:
+            collection.bulk_write(operations, ordered=False)
+            migrated[name] += len(operations)
+    return migrated
+
+
+def find_interfaces(collection, **criteria):
+    """
+    Query the fleet wide interface collection eg. find_interfaces(interfaces, status="up", proto="down")
+    :param collection: fleet wide interface collection.
+    :param criteria: field and value to match, eg. device, intf, ipaddr, status, proto.
+    :return: list of interfaces.
+    """
+    return list(collection.find(criteria, {"_id": 0}))
+
+
+def interfaces_down(collection, device=None):
+    """
+    All the interfaces of the fleet which are not up/up, with one query on the up_up index.
+    :param collection: fleet wide interface collection.
+    :param device: optional, only this router.
+    :return: list of interfaces.
+    """
+    query = {"up_up": False}
+    if device is not None:
+        query["device"] = device
+    return list(collection.find(query, {"_id": 0}))
+
+
+def ensure_event_indexes(events):
+    """
+    Create the indexes used by the interface change event functions, does nothing if they exist.
+    :param events: collection of interface change events.
+    :return:
+    """
+    events.create_index([("device", ASCENDING), ("intf", ASCENDING), ("ts", DESCENDING)])
+    _latest_state(events).create_index([("device", ASCENDING), ("intf", ASCENDING)], unique=True)
+
+
+def _latest_state(events):
+    # one document per device and intf with the state of the latest event, eg. interface_events_latest.
+    return events.database[f"{events.name}_latest"]
+
+
+def _latest_events(events, device, at=None):
+    # the latest event of every interface of the device, at or before the time at.
+    match = {"device": device}
+    if at is not None:
+        match["ts"] = {"$lte": at}
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"intf": 1, "ts": -1}},
+        {"$group": {"_id": "$intf", "ipaddr": {"$first": "$ipaddr"}, "status": {"$first": "$status"},
+                    "proto": {"$first": "$proto"}, "removed": {"$first": "$removed"}}},
+    ]
+    return {event["_id"]: event for event in events.aggregate(pipeline) if not event.get("removed")}
+
+
+def _current_state(events, device):
+    """
+    The latest state of every interface of the device from the latest state collection,
+    which is seeded once from the event history if it has nothing for the device.
+    :return: dictionary of intf and dictionary of ipaddr, status and proto.
+    """
+    latest = _latest_state(events)
+    current = {row["intf"]: row for row in latest.find({"device": device}, {"_id": 0})}
+    if current:
+        return current
+    current = _latest_events(events, device)
+    if current:
+        latest.bulk_write([UpdateOne({"device": device, "intf": intf},
+                                     {"$set": {field: event.get(field) for field in ("ipaddr", "status", "proto")}},
+                                     upsert=True) for intf, event in current.items()], ordered=False)
+    return current
+
+
+def record_interface_changes(events, device, interface_result, timestamp=None):
+    """
+    Append an event only for the interfaces whose ipaddr, status or proto changed since the
+    last event, instead of storing the whole interface table on every poll.
+    The last state is read from the small latest state collection, not from the event history,
+    so the cost of a poll does not grow with the history.
+    Interfaces seen for the first time are recorded with changed ["added"],
+    interfaces no longer on the router are recorded with removed True.
+    :param events: collection of interface change events.
+    :param device: name or ip of the router eg. R1
+    :param interface_result: result of show ip int brief.
+    :param timestamp: optional, time of the poll, default is now in utc.
+    :return: number of events written.
+    """
+    timestamp = timestamp or datetime.now(timezone.utc)
+    current = _current_state(events, device)
+    new_events = []
+    seen = set()
+    for row in interface_result:
+        intf = row["intf"]
+        seen.add(intf)
+        state = {field: row.get(field) for field in ("ipaddr", "status", "proto")}
+        last = current.get(intf)
+        if last is None:
+            changed = ["added"]
+        else:
+            changed = [field for field, value in state.items() if last.get(field) != value]
+        if changed:
+            new_events.append(dict(device=device, intf=intf, ts=timestamp, changed=changed, **state))
+    for intf in current.keys() - seen:
+        new_events.append(dict(device=device, intf=intf, ts=timestamp, changed=["removed"], removed=True))
+    if new_events:
+        events.insert_many(new_events)
+        _latest_state(events).bulk_write(
+            [DeleteOne({"device": device, "intf": event["intf"]}) if event.get("removed") else
+             UpdateOne({"device": device, "intf": event["intf"]},
+                       {"$set": {field: event[field] for field in ("ipaddr", "status", "proto", "ts")}}, upsert=True)
+             for event in new_events], ordered=True)
+    return len(new_events)
+
+
+def interface_state_at(events, device, at):
+    """
+    Rebuild the interface table of the router as it was at the time.
+    :param events: collection of interface change events.
+    :param device: name or ip of the router.
+    :param at: datetime
+    :return: list of dictionary with intf, ipaddr, status and proto, same as show ip int brief.
+    """
+    return [dict(intf=intf, ipaddr=event["ipaddr"], status=event["status"], proto=event["proto"])
+            for intf, event in sorted(_latest_events(events, device, at).items())]
+
+
+def interface_flap_count(events, device, intf=None, since=None, until=None):
+    """
+    Count the status changes of the interfaces of the router.
+    :param events: collection of interface change events.
+    :param device: name or ip of the router.
+    :param intf: optional, only count this interface.
+    :param since: optional, datetime to count from.
+    :param until: optional, datetime to count until.
+    :return: dictionary of intf and number of status changes.
+    """
+    match = {"device": device, "changed": "status"}
+    if intf is not None:
+        match["intf"] = intf
+    if since is not None or until is not None:
+        match["ts"] = {}
+        if since is not None:
+            match["ts"]["$gte"] = since
+        if until is not None:
+            match["ts"]["$lte"] = until
+    pipeline = [{"$match": match}, {"$group": {"_id": "$intf", "flaps": {"$sum": 1}}}]
+    return {result["_id"]: result["flaps"] for result in events.aggregate(pipeline)}
+
+
 def get_interface_brief(**device_config):
     """
     Get the result of show ip int brief for cisco ios based routers.
+    The result is cached in show_cache, config_router invalidates the cache of the router.
     :param device_config: device info required by netmiko
     :return: result of the cisco command.
     """
-    with ConnectHandler(**device_config) as conn:
+    found, result = show_cache.get(device_config, "show ip int brief")
+    if found:
+        return result
+    with connect_device(**device_config) as conn:
         result = conn.send_command("show ip int brief", use_textfsm=True)
+    show_cache.put(device_config, "show ip int brief", result)
     return result
 
 
+def _run_job(job, device_config, started, index, *args, **kwargs):
+    """
+    Run one job for one device, the job can be a function or the name of a CiscoIOS method.
+    Functions which only accept the device as keyword arguments such as get_interface_brief
+    are called with **device_config, others are called with device_config as first argument.
+    The start time is recorded in started by the submission index, as devices can share an ip.
+    """
+    started[index] = monotonic()
+    if isinstance(job, str):
+        router = CiscoIOS(ip=device_config["ip"],
+                          username=device_config["username"],
+                          password=device_config["password"],
+                          secret=device_config.get("secret"),
+                          port=device_config.get("port", 22))
+        return getattr(router, job)(*args, **kwargs)
+    params = list(signature(job).parameters.values())
+    if params and params[0].kind is Parameter.VAR_KEYWORD:
+        if args:
+            raise TypeError(f"{job.__name__} only accepts keyword arguments, got positional arguments {args}.")
+        return job(**device_config, **kwargs)
+    return job(device_config, *args, **kwargs)
+
+
+def run_fleet(job, device_configs, *args, max_workers=32, timeout=None, precheck=False, **kwargs):
+    """
+    Run the job across many devices with a bounded pool of threads, the results are
+    yielded as soon as each device completes, the order is not the order of device_configs.
+    Usage:
+    for (ip, port), result, error in run_fleet(get_interface_brief, device_configs):
+        ...
+    for (ip, port), result, error in run_fleet(config_router, device_configs, config_what="ospf", **ospf_config):
+        ...
+    for (ip, port), result, error in run_fleet("set_hostname", device_configs, "R1"):
+        ...
+    :param job: function such as config_router, get_interface_brief or the name of a CiscoIOS method.
+    :param device_configs: list of device config from get_device_config, or list of tuples of
+    (device_config, dict of keyword arguments for this device only).
+    :param args: positional arguments passed to the job for every device.
+    :param max_workers: maximum number of devices worked on at the same time.
+    :param timeout: seconds a device is allowed to run, the device is reported with TimeoutError
+    when exceeded, the stuck thread is left to netmiko's own timeouts.
+    :param precheck: check the ssh port of all devices in parallel first, devices which are not
+    reachable or skipped by the circuit breaker are reported with DeviceUnavailable without running the job.
+    :param kwargs: keyword arguments passed to the job for every device.
+    :return: generator of tuples ((ip, port), result, exception), exception is None if the job succeeded.
+    """
+    started = dict()
+    items = [item if isinstance(item, tuple) else (item, {}) for item in device_configs]
+    if precheck:
+        allowed = [circuit_breaker.allow(circuit_breaker.device_key(device_config)) for device_config, _ in items]
+        reachable = iter(check_reachable([device_config for (device_config, _), allow in zip(items, allowed)
+                                          if allow]))
+        checked = []
+        for (device_config, device_kwargs), allow in zip(items, allowed):
+            if allow and next(reachable):
+                checked.append((device_config, device_kwargs))
+                continue
+            key = circuit_breaker.device_key(device_config)
+            if allow:
+                circuit_breaker.record_failure(key)
+            yield key, None, DeviceUnavailable(f"{key[0]}:{key[1]} is not reachable or skipped after "
+                                               f"repeated failures.")
+        items = checked
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = dict()
+    try:
+        for index, (device_config, device_kwargs) in enumerate(items):
+            future = executor.submit(_run_job, job, device_config, started, index, *args,
+                                     **{**kwargs, **device_kwargs})
+            pending[future] = (index, circuit_breaker.device_key(device_config))
+        while pending:
+            done, _ = wait(pending, timeout=None if timeout is None else 1, return_when=FIRST_COMPLETED)
+            for future in done:
+                _, key = pending.pop(future)
+                error = future.exception()
+                yield key, None if error else future.result(), error
+            if timeout is None:
+                continue
+            now = monotonic()
+            for future, (index, key) in list(pending.items()):
+                if index in started and now - started[index] > timeout:
+                    del pending[future]
+                    yield key, None, TimeoutError(f"{key[0]}:{key[1]} did not complete within {timeout}s.")
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
 if __name__ == "__main__":
     from time import sleep
 
-    client = MongoClient("mongodb://192.168.1.245:27017")
+    client = mongodb_client("mongodb://192.168.1.245:27017")
+    precompile_templates("templates")
     # Demonstration on how to use the function.
 
-    # Get the r1 router device information from mongodb
-    r1_device_config = get_device_config(dbname="network", table_name="devices", ip="192.168.1.215")
-
-    # Get the r2 router device information from mongodb
-    r2_device_config = get_device_config(dbname="network", table_name="devices", ip="192.168.1.232")
+    # Get the r1 and r2 router device information from mongodb with one query
+    r1_device_config, r2_device_config = get_devices_config(dbname="network", table_name="devices",
+                                                            ips=["192.168.1.215", "192.168.1.232"])
 
     # ospf configuration for r1
     r1_ospf_config = dict(
@@ -179,33 +649,43 @@ if __name__ == "__main__":
         "up": True
     }
 
+    # All the routers' interfaces are in one collection, keyed by device and intf.
+    interfaces = client["network"]["interfaces"]
+    ensure_fleet_indexes(interfaces)
+    names = {"192.168.1.215": "R1", "192.168.1.232": "R2"}
+
     # Usage 1: Configure loopback4 and update mongodb
     config_router(r1_device_config, config_what="intf", **r1_intf_config)
     r1_result = get_interface_brief(**r1_device_config)
-    r1_table = client["network"]["R1"]
-    refresh_collection(r1_table, r1_result)
+    refresh_fleet_interfaces(interfaces, "R1", r1_result)
 
     # Usage 2: remove loopback4 and update mongodb
     config_router(r1_device_config, config_what="no.loopback4")
     r1_result = get_interface_brief(**r1_device_config)
-    r1_table = client["network"]["R1"]
-    refresh_collection(r1_table, r1_result)
+    refresh_fleet_interfaces(interfaces, "R1", r1_result)
 
     # Update R2 router interface in mongodb
     r2_result = get_interface_brief(**r2_device_config)
-    r2_table = client["network"]["R2"]
-    refresh_collection(r2_table, r2_result)
+    refresh_fleet_interfaces(interfaces, "R2", r2_result)
 
-    # Usage 3: Configure ospf and interface and update mongodb
-    config_router(r1_device_config, config_what="ospf", **r1_ospf_config)
+    # Usage 3: Configure ospf on r1 and r2 at the same time and update mongodb
+    ospf_jobs = [(r1_device_config, r1_ospf_config), (r2_device_config, r2_ospf_config)]
+    for (ip, port), result, error in run_fleet(config_router, ospf_jobs, config_what="ospf", precheck=True):
+        print(ip, error if error else "ospf configured.")
+    # wait once for ospf adjacency instead of once per router.
     sleep(5)
-    r1_result = get_interface_brief(**r1_device_config)
-    r1_table = client["network"]["R2"]
-    refresh_collection(r1_table, r1_result)
+    for (ip, port), result, error in run_fleet(get_interface_brief, [r1_device_config, r2_device_config]):
+        if error is None:
+            refresh_fleet_interfaces(interfaces, names[ip], result)
+    print(interfaces_down(interfaces))
 
-    # Usage 4: Configure ospf and interface and update mongodb
-    config_router(r2_device_config, config_what="ospf", **r2_ospf_config)
-    sleep(5)
-    r2_result = get_interface_brief(**r2_device_config)
-    r2_table = client["network"]["R2"]
-    refresh_collection(r2_table, r2_result)
+    # Usage 4: keep the history of interface changes, only changes are written.
+    events = client["network"]["interface_events"]
+    ensure_event_indexes(events)
+    for (ip, port), result, error in run_fleet(get_interface_brief, [r1_device_config, r2_device_config]):
+        if error is None:
+            record_interface_changes(events, names[ip], result)
+    print(interface_flap_count(events, "R1"))
+
+    # Usage 5: move the old network.R1, network.R2 collections into network.interfaces
+    print(migrate_per_router_collections(client["network"], names=["R1", "R2"]))
@@ -1,8 +1,39 @@
 from pymongo import MongoClient
-from netmiko import ConnectHandler
+from netmiko import ConnectHandler, file_transfer
 from functools import wraps
-from jinja2 import Environment, FileSystemLoader
-from ipaddress import IPv4Network
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+from ipaddress import IPv4Network, collapse_addresses
+from contextlib import contextmanager
+from time import monotonic, sleep, perf_counter
+import atexit
+import gzip
+import json
+import re
+import tempfile
+import uuid
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from copy import deepcopy
+import os
+import threading
+
+
+# MongoClient is thread safe and has its own connection pool, one client per address is enough.
+_mongo_clients = dict()
+_mongo_lock = threading.Lock()
+
+
+def mongodb_client(mongo_addr):
+    """
+    Get the shared MongoClient of the mongodb address, the client is created on first use.
+    :param mongo_addr: eg. mongdb://192.168.1.245:27017
+    :return: MongoClient object
+    """
+    with _mongo_lock:
+        if mongo_addr not in _mongo_clients:
+            _mongo_clients[mongo_addr] = MongoClient(mongo_addr)
+        return _mongo_clients[mongo_addr]
 
 
 def mongodb_table(mongo_addr, dbname, tablename):
@@ -13,8 +44,7 @@ def mongodb_table(mongo_addr, dbname, tablename):
     :param tablename: collection name
     :return: mongodb collection object
     """
-    client = MongoClient(mongo_addr)
-    return client[dbname][tablename]
+    return mongodb_client(mongo_addr)[dbname][tablename]
 
 
 def mongodb_insert_many(db_cursor, data_list):
@@ -38,24 +68,736 @@ def mongdb_find_one(db_cursor, filter, exclude):
     return db_cursor.find_one(filter, exclude)
 
 
+# One jinja2 environment per template directory, shared by every caller.
+_template_envs = dict()
+_template_lock = threading.Lock()
+
+
+def template_env(template_path="templates"):
+    """
+    Get the shared jinja2 environment of the template directory.
+    Compiled templates are kept in memory and the bytecode is cached on disk so that
+    a new python process does not compile the templates again, a template is compiled
+    again only if its file modification time changes.
+    :param template_path: j2 template location
+    :return: Environment object
+    """
+    template_path = os.path.abspath(template_path)
+    with _template_lock:
+        if template_path not in _template_envs:
+            _template_envs[template_path] = Environment(
+                loader=FileSystemLoader(template_path),
+                bytecode_cache=FileSystemBytecodeCache(),
+                auto_reload=True,
+                cache_size=-1
+            )
+        return _template_envs[template_path]
+
+
+def precompile_templates(template_path="templates"):
+    """
+    Compile every template in the directory ahead of use, eg. at startup.
+    :param template_path: j2 template location
+    :return: list of compiled template names.
+    """
+    env = template_env(template_path)
+    names = env.list_templates()
+    for name in names:
+        env.get_template(name)
+    return names
+
+
+class DeviceInventory:
+    """
+    Cache of device configs from the devices collection, keyed by ip.
+    Many devices are fetched with one $in query, cached entries are refreshed after ttl seconds.
+    """
+
+    def __init__(self, collection, ttl=300):
+        """
+        :param collection: mongodb collection which has the device configs.
+        :param ttl: seconds a device config is cached.
+        """
+        self.collection = collection
+        self.ttl = ttl
+        self._devices = dict()
+        self._lock = threading.Lock()
+        self._indexed = False
+
+    def _ensure_index(self):
+        if not self._indexed:
+            self.collection.create_index("ip")
+            self._indexed = True
+
+    def prefetch(self, ips):
+        """
+        Fetch the device configs which are not cached or expired with one query.
+        :param ips: list of mgmt ip addresses.
+        :return:
+        """
+        now = monotonic()
+        with self._lock:
+            missing = list({ip for ip in ips
+                            if ip not in self._devices or now - self._devices[ip][1] > self.ttl})
+        if not missing:
+            return
+        self._ensure_index()
+        found = {device["ip"]: device for device in
+                 self.collection.find({"ip": {"$in": missing}}, {"_id": 0})}
+        with self._lock:
+            for ip in missing:
+                self._devices[ip] = (found.get(ip), now)
+
+    def get(self, ip):
+        """
+        Get one device config.
+        :param ip: mgmt ip address.
+        :return: device config in dictionary, None if the device is not in the collection.
+        """
+        return self.get_many([ip])[ip]
+
+    def get_many(self, ips):
+        """
+        Get the device configs of many devices.
+        :param ips: list of mgmt ip addresses.
+        :return: dictionary of ip and device config.
+        """
+        self.prefetch(ips)
+        with self._lock:
+            return {ip: self._devices[ip][0] for ip in ips}
+
+    def invalidate(self, ip=None):
+        """
+        Remove the device from cache, or everything if ip is not specified.
+        :param ip: mgmt ip address.
+        :return:
+        """
+        with self._lock:
+            if ip is None:
+                self._devices.clear()
+            else:
+                self._devices.pop(ip, None)
+
+
+_inventories = dict()
+
+
+def device_inventory(mongo_addr, dbname, tablename, ttl=300):
+    """
+    Get the shared DeviceInventory of the collection.
+    :param mongo_addr: eg. mongdb://192.168.1.245:27017
+    :param dbname: database name
+    :param tablename: collection name
+    :param ttl: seconds a device config is cached, only used when the inventory is created.
+    :return: DeviceInventory object
+    """
+    key = (mongo_addr, dbname, tablename)
+    with _mongo_lock:
+        inventory = _inventories.get(key)
+    if inventory is None:
+        inventory = DeviceInventory(mongodb_table(mongo_addr, dbname, tablename), ttl=ttl)
+        with _mongo_lock:
+            inventory = _inventories.setdefault(key, inventory)
+    return inventory
+
+
 def config_template(template_path="templates", template_file=None):
-    loader = FileSystemLoader(template_path)
-    return Environment(loader=loader).get_template(template_file)
+    return template_env(template_path).get_template(template_file)
+
+
+class PhaseTimings:
+    """
+    Histograms of how long each phase of a device operation takes, keyed by device, method and phase.
+    The phases are connect, enable, command, save_config and disconnect.
+    """
+
+    # upper bounds of the histogram buckets in seconds, the last bucket is everything above.
+    buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self._histograms = dict()
+        self._lock = threading.Lock()
+
+    def record(self, device, method, phase, seconds):
+        """
+        Add one timing.
+        :param device: ip address of the device.
+        :param method: name of the CiscoIOS method.
+        :param phase: connect, enable, command, save_config or disconnect.
+        :param seconds: duration of the phase.
+        :return:
+        """
+        key = (device, method, phase)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = dict(count=0, sum=0.0, max=0.0,
+                                                         buckets=[0] * (len(self.buckets) + 1))
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            histogram["max"] = max(histogram["max"], seconds)
+            histogram["buckets"][next((index for index, bound in enumerate(self.buckets) if seconds <= bound),
+                                      len(self.buckets))] += 1
+
+    @contextmanager
+    def timed(self, device, method, phase):
+        """
+        Record the duration of the with block, also when the block raises an exception.
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(device, method, phase, perf_counter() - start)
+
+    def snapshot(self):
+        """
+        :return: list of dictionary, one per device, method and phase.
+        """
+        with self._lock:
+            return [dict(device=device, method=method, phase=phase, count=histogram["count"],
+                         sum=histogram["sum"], max=histogram["max"],
+                         buckets=dict(zip([*map(str, self.buckets), "+Inf"], histogram["buckets"])))
+                    for (device, method, phase), histogram in self._histograms.items()]
+
+    def to_json(self, path=None):
+        """
+        Dump the histograms as json.
+        :param path: optional, file to write to.
+        :return: json string.
+        """
+        output = json.dumps(self.snapshot(), indent=2)
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(output)
+        return output
+
+    def to_prometheus(self):
+        """
+        The histograms in prometheus text format, to be served for scraping.
+        :return: string
+        """
+        lines = ["# TYPE netscript_phase_seconds histogram"]
+        for item in self.snapshot():
+            labels = f'device="{item["device"]}",method="{item["method"]}",phase="{item["phase"]}"'
+            cumulative = 0
+            for bound, count in item["buckets"].items():
+                cumulative += count
+                lines.append(f'netscript_phase_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"netscript_phase_seconds_sum{{{labels}}} {item['sum']}")
+            lines.append(f"netscript_phase_seconds_count{{{labels}}} {item['count']}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+# Shared by the show and config decorators and the session pool.
+phase_timings = PhaseTimings()
+
+
+class DeviceUnavailable(ConnectionError):
+    """
+    The device is skipped because it failed too many times recently or is not reachable.
+    """
+
+
+class CircuitBreaker:
+    """
+    Skip devices which failed to connect repeatedly instead of waiting for the ssh connect
+    timeout every time. After failures within window seconds the device is skipped for cooldown
+    seconds, then one attempt is allowed, the cooldown doubles every time that attempt fails.
+    Devices are keyed by ip and port, see device_key, as several devices can share an address,
+    eg. behind a terminal server.
+    """
+
+    def __init__(self, failures=3, window=300, cooldown=30, max_cooldown=600):
+        """
+        :param failures: number of failures within window which opens the breaker.
+        :param window: seconds the failures are counted in.
+        :param cooldown: seconds the device is skipped the first time.
+        :param max_cooldown: maximum seconds the device is skipped.
+        """
+        self.failures = failures
+        self.window = window
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._devices = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def device_key(device):
+        """
+        :param device: netmiko device dictionary.
+        :return: tuple of ip and port.
+        """
+        return device.get("ip", device.get("host")), device.get("port", 22)
+
+    def allow(self, key):
+        """
+        :param key: tuple of ip and port of the device, see device_key.
+        :return: False if the device must be skipped.
+        """
+        return self.retry_in(key) == 0
+
+    def retry_in(self, key):
+        """
+        :param key: tuple of ip and port of the device, see device_key.
+        :return: seconds until the device is tried again, 0 if it can be tried now.
+        """
+        with self._lock:
+            state = self._devices.get(key)
+            if state is None or state["open_until"] is None:
+                return 0
+            return max(0.0, state["open_until"] - monotonic())
+
+    def record_success(self, key):
+        with self._lock:
+            self._devices.pop(key, None)
+
+    def record_failure(self, key):
+        now = monotonic()
+        with self._lock:
+            state = self._devices.setdefault(key, dict(failures=[], trips=0, open_until=None))
+            state["failures"] = [failed for failed in state["failures"] if now - failed <= self.window] + [now]
+            # a failed attempt after the cooldown opens the breaker again straight away.
+            if len(state["failures"]) >= self.failures or state["open_until"] is not None:
+                state["trips"] += 1
+                state["open_until"] = now + min(self.cooldown * 2 ** (state["trips"] - 1), self.max_cooldown)
+
+
+# Shared by connect_device, the session pool and net1.
+circuit_breaker = CircuitBreaker()
+
+
+def connect_device(breaker=None, retries=0, backoff=1.0, **device):
+    """
+    ConnectHandler with a circuit breaker and retries with exponential backoff.
+    :param breaker: CircuitBreaker, default is the shared circuit_breaker.
+    :param retries: number of times to try again after a failed connect.
+    :param backoff: seconds to wait before the first retry, doubles on every retry.
+    :param device: device info for netmiko ConnectHandler.
+    :return: netmiko connection object.
+    """
+    breaker = circuit_breaker if breaker is None else breaker
+    key = breaker.device_key(device)
+    for attempt in range(retries + 1):
+        if not breaker.allow(key):
+            raise DeviceUnavailable(f"{key[0]}:{key[1]} is skipped for {breaker.retry_in(key):.0f}s "
+                                    f"after repeated failures.")
+        try:
+            session = ConnectHandler(**device)
+        except Exception:
+            breaker.record_failure(key)
+            if attempt == retries:
+                raise
+            sleep(backoff * 2 ** attempt)
+        else:
+            breaker.record_success(key)
+            return session
+
+
+def check_reachable(devices, timeout=1.0, max_workers=64):
+    """
+    Check in parallel that the ssh port of the devices accepts tcp connections, much faster
+    than waiting for the ssh connect timeout of devices which are down.
+    :param devices: list of device info for netmiko, the ip and port are used.
+    :param timeout: seconds to wait for each device.
+    :param max_workers: number of devices checked at the same time.
+    :return: list of True if reachable or False, one per device in the order of devices.
+    """
+    def reachable(device):
+        try:
+            with socket.create_connection(CircuitBreaker.device_key(device), timeout=timeout):
+                return True
+        except OSError:
+            return False
+
+    with ThreadPoolExecutor(max_workers=max_workers) as e:
+        return list(e.map(reachable, devices))
+
+
+class SessionPool:
+    """
+    Keeps netmiko sessions open between calls so that every operation does not pay
+    for the ssh handshake and enable again.
+    Sessions are keyed by the device's ip, port and credentials, a session is borrowed
+    with acquire (or the session context manager) and returned with release.
+    Idle sessions past idle_timeout are disconnected by acquire, release and a background reaper
+    thread which runs while the pool has idle sessions.
+    """
+
+    def __init__(self, max_sessions=2, idle_timeout=300, connect=connect_device):
+        """
+        :param max_sessions: maximum number of open sessions per device.
+        :param idle_timeout: seconds an unused session is kept open before it is disconnected.
+        :param connect: callable which returns a netmiko connection, default is connect_device
+        which is ConnectHandler with the shared circuit_breaker.
+        """
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.connect = connect
+        self._idle = dict()
+        self._in_use = dict()
+        self._lock = threading.Condition()
+        self._reaper = None
+
+    @staticmethod
+    def device_key(device):
+        """
+        The key identifies one device with one set of credentials.
+        :param device: netmiko device dictionary.
+        :return: tuple of ip, port, username, password and secret.
+        """
+        return (device.get("ip", device.get("host")), device.get("port", 22),
+                device.get("username"), device.get("password"), device.get("secret"))
+
+    def acquire(self, device, timeout=None):
+        """
+        Borrow a live session for the device, a new session is opened if there is no
+        idle session and max_sessions is not reached, otherwise wait for a session to be returned.
+        :param device: netmiko device dictionary.
+        :param timeout: seconds to wait for a free session, None waits forever.
+        :return: netmiko connection object.
+        """
+        key = self.device_key(device)
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            with self._lock:
+                expired = self._pop_expired()
+                idle = self._idle.get(key, [])
+                if idle:
+                    session, _ = idle.pop()
+                elif self._in_use.get(key, 0) < self.max_sessions:
+                    session = None
+                else:
+                    remaining = None if deadline is None else deadline - monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError(f"No free session for {key[0]} within {timeout}s.")
+                    self._lock.wait(remaining)
+                    continue
+                self._in_use[key] = self._in_use.get(key, 0) + 1
+            self._disconnect_all(expired)
+            if session is not None:
+                if self._is_alive(session):
+                    return session
+                self._disconnect_all([session])
+                self._forget(key)
+                continue
+            try:
+                return self.connect(**device)
+            except Exception:
+                self._forget(key)
+                raise
+
+    def release(self, device, session, discard=False):
+        """
+        Return the borrowed session to the pool.
+        :param device: netmiko device dictionary used in acquire.
+        :param session: the borrowed session.
+        :param discard: disconnect the session instead of keeping it, eg. after an error.
+        :return:
+        """
+        key = self.device_key(device)
+        expired = []
+        if discard:
+            self._disconnect_all([session])
+        else:
+            with self._lock:
+                expired = self._pop_expired()
+                self._idle.setdefault(key, []).append((session, monotonic()))
+                if self._reaper is None:
+                    self._reaper = threading.Thread(target=self._reap, name="session-pool-reaper", daemon=True)
+                    self._reaper.start()
+        self._disconnect_all(expired)
+        self._forget(key)
+
+    def _reap(self):
+        # disconnect expired idle sessions of devices which are not borrowed again, stops when nothing is idle.
+        interval = min(max(self.idle_timeout / 2, 1), 60)
+        while True:
+            sleep(interval)
+            with self._lock:
+                expired = self._pop_expired()
+                idle = any(self._idle.values())
+                if not idle:
+                    self._reaper = None
+            self._disconnect_all(expired)
+            if not idle:
+                return
+
+    @contextmanager
+    def session(self, device, timeout=None):
+        """
+        Borrow a session for the duration of the with block, the session is discarded if
+        the block raises an exception or a generator using it is closed early,
+        as the channel may be in an unknown state.
+        :param device: netmiko device dictionary.
+        :param timeout: seconds to wait for a free session.
+        :return: netmiko connection object.
+        """
+        session = self.acquire(device, timeout=timeout)
+        try:
+            yield session
+        except BaseException:
+            self.release(device, session, discard=True)
+            raise
+        self.release(device, session)
+
+    def close(self, device=None):
+        """
+        Disconnect idle sessions, sessions which are borrowed are not affected.
+        :param device: if specified only close the sessions of this device, else close all.
+        :return:
+        """
+        with self._lock:
+            if device is None:
+                keys = list(self._idle)
+            else:
+                keys = [self.device_key(device)]
+            sessions = [session for key in keys for session, _ in self._idle.pop(key, [])]
+        self._disconnect_all(sessions)
+
+    def _forget(self, key):
+        with self._lock:
+            self._in_use[key] -= 1
+            if not self._in_use[key]:
+                del self._in_use[key]
+            self._lock.notify_all()
+
+    def _pop_expired(self):
+        # must be called with the lock held, the sessions are disconnected outside of the lock.
+        expired = []
+        now = monotonic()
+        for key, idle in list(self._idle.items()):
+            expired.extend(session for session, last_used in idle if now - last_used > self.idle_timeout)
+            idle[:] = [(session, last_used) for session, last_used in idle
+                       if now - last_used <= self.idle_timeout]
+            if not idle:
+                del self._idle[key]
+        return expired
+
+    @staticmethod
+    def _is_alive(session):
+        try:
+            return session.is_alive()
+        except Exception:
+            return False
+
+    @staticmethod
+    def _disconnect_all(sessions):
+        for session in sessions:
+            try:
+                with phase_timings.timed(getattr(session, "host", None), "pool", "disconnect"):
+                    session.disconnect()
+            except Exception:
+                pass
+
+
+# Shared by all CiscoIOS objects, idle sessions are disconnected when python exits.
+session_pool = SessionPool()
+atexit.register(session_pool.close)
+
+
+class ShowCache:
+    """
+    Cache of show command results per device and per command, results expire after ttl seconds.
+    The config methods invalidate the cache of the device they configure.
+    Results are copied in and out, callers may modify them, eg. insert_many adds _id to the dictionaries.
+    """
+
+    def __init__(self, ttl=10):
+        """
+        :param ttl: seconds a result is cached, 0 disables the cache.
+        """
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._results = dict()
+        self._lock = threading.Lock()
+
+    def get(self, device, command):
+        """
+        Get the cached result.
+        :param device: netmiko device dictionary.
+        :param command: the key of the command, eg. show ip int brief.
+        :return: tuple of (found, result).
+        """
+        key = SessionPool.device_key(device)
+        with self._lock:
+            expires, result = self._results.get(key, {}).get(command, (0, None))
+            if expires > monotonic():
+                self.hits += 1
+                return True, deepcopy(result)
+            self.misses += 1
+            return False, None
+
+    def put(self, device, command, result):
+        """
+        Cache the result of the command.
+        :param device: netmiko device dictionary.
+        :param command: the key of the command.
+        :param result: output of the command.
+        :return:
+        """
+        if self.ttl <= 0:
+            return
+        key = SessionPool.device_key(device)
+        with self._lock:
+            self._results.setdefault(key, {})[command] = (monotonic() + self.ttl, deepcopy(result))
+
+    def invalidate(self, device=None):
+        """
+        Remove the cached results of the device, or of all devices.
+        :param device: netmiko device dictionary.
+        :return:
+        """
+        with self._lock:
+            if device is None:
+                self._results.clear()
+            else:
+                self._results.pop(SessionPool.device_key(device), None)
+
+    def stats(self):
+        """
+        :return: dictionary of hits, misses and number of cached results.
+        """
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        size=sum(len(results) for results in self._results.values()))
+
+
+# Shared by all CiscoIOS objects and net1.get_interface_brief.
+show_cache = ShowCache()
+
+
+class SaveScheduler:
+    """
+    Coalesce save_config per device, config methods mark the device dirty and one save_config
+    is done after the device has not been changed for the debounce window, or at flush.
+    A device stays dirty until its save succeeds, a failed background save is tried again
+    after its delay doubled on every failure, up to max_retries times, and at flush.
+    """
+
+    def __init__(self, debounce=5.0, max_retries=5, max_backoff=300, max_errors=100):
+        """
+        :param debounce: default seconds to wait for more changes before saving.
+        :param max_retries: number of background retries of a failed save, the device stays dirty
+        after that until it is changed again or flushed.
+        :param max_backoff: maximum seconds between retries.
+        :param max_errors: number of most recent background errors kept in errors.
+        """
+        self.debounce = debounce
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.saves = 0
+        self.errors = deque(maxlen=max_errors)
+        self._dirty = dict()
+        self._saving = dict()
+        self._lock = threading.Lock()
+
+    def mark_dirty(self, device, pool, delay=None):
+        """
+        Schedule a save_config of the device, a save already scheduled is pushed back.
+        :param device: netmiko device dictionary.
+        :param pool: SessionPool to borrow the session from.
+        :param delay: seconds to wait, default is debounce.
+        :return:
+        """
+        self._schedule(device, pool, self.debounce if delay is None else delay, failures=0)
+
+    def _schedule(self, device, pool, delay, failures):
+        key = SessionPool.device_key(device)
+        wait = min(delay * 2 ** failures, self.max_backoff) if failures else delay
+        timer = threading.Timer(wait, self._save_in_background, args=(key,))
+        timer.daemon = True
+        with self._lock:
+            if key in self._dirty:
+                self._dirty[key]["timer"].cancel()
+            self._dirty[key] = dict(device=device, pool=pool, timer=timer, delay=delay, failures=failures)
+        timer.start()
+
+    def pending(self):
+        """
+        :return: list of ip addresses of the devices waiting to be saved.
+        """
+        with self._lock:
+            return [entry["device"].get("ip") for entry in self._dirty.values()]
+
+    def flush(self, device=None):
+        """
+        Save now instead of waiting, errors are raised after every device is tried.
+        :param device: if specified only save this device, else save all dirty devices.
+        :return:
+        """
+        with self._lock:
+            keys = list(self._dirty) if device is None else [SessionPool.device_key(device)]
+        errors = []
+        for key in keys:
+            try:
+                self._save(key)
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
+    def _save_in_background(self, key):
+        try:
+            self._save(key)
+        except Exception as e:
+            with self._lock:
+                self.errors.append((key[0], e))
+                entry = self._dirty.get(key)
+            # retried with the device's own delay, backing off, the device stays dirty for flush.
+            if entry is not None and entry["failures"] < self.max_retries:
+                self._schedule(entry["device"], entry["pool"], entry["delay"], entry["failures"] + 1)
+
+    def _save(self, key):
+        # one save per device at a time, flush waits here for a save in progress in a timer thread.
+        with self._lock:
+            saving = self._saving.setdefault(key, threading.Lock())
+        with saving:
+            with self._lock:
+                entry = self._dirty.get(key)
+            if entry is None:
+                return
+            entry["timer"].cancel()
+            device = entry["device"]
+            with entry["pool"].session(device) as session:
+                with phase_timings.timed(device.get("ip"), "save_scheduler", "save_config"):
+                    session.save_config()
+            with self._lock:
+                # a change marked during the save keeps the device dirty.
+                if self._dirty.get(key) is entry:
+                    del self._dirty[key]
+                self.saves += 1
+
+
+# Shared by CiscoIOS objects created with save_delay, dirty devices are saved when python exits.
+save_scheduler = SaveScheduler()
+atexit.register(save_scheduler.flush)
 
 
 def show(fn):
     """
-    This decorator ensure enable mode before fn, and disconnect after fn.
+    This decorator returns the cached result if fn was called recently with the same arguments,
+    else borrows a session from the pool and ensure enable mode before fn,
+    the session is returned to the pool after fn. The phases are timed in phase_timings.
     :param fn: function which has at least self as argument.
     :return: output of fn, and the wrapper.
     """
 
     @wraps(fn)
     def wrapper(self, *args, **kwargs):
-        if not self.session.check_enable_mode():
-            self.session.enable()
-        output = fn(self, *args, **kwargs)
-        self.session.disconnect()
+        command = (fn.__name__, args, tuple(sorted(kwargs.items())))
+        found, output = self.cache.get(self.device, command)
+        if found:
+            return output
+        with self._borrow(fn.__name__):
+            with phase_timings.timed(self.ip, fn.__name__, "command"):
+                output = fn(self, *args, **kwargs)
+        self.cache.put(self.device, command, output)
         return output
 
     return wrapper
@@ -63,8 +805,13 @@ def show(fn):
 
 def config(fn):
     """
-    This is a decorator ensure enable mode before fn, and execute save_config and disconnect
-    after fn is executed.
+    This is a decorator borrows a session from the pool and ensure enable mode before fn,
+    and execute save_config after fn is executed, the session is returned to the pool.
+    The cached show results of the device are invalidated, save_config is skipped if
+    nothing was sent because the router already has the configuration.
+    If the CiscoIOS object has a save_delay the save is left to save_scheduler.
+    The phases are timed in phase_timings.
+    Inside CiscoIOS.transaction fn only queues its commands, nothing is sent until commit.
     :param fn: function to execute, has at least class instance as argument (self), can accept
     positional arguments (*args) and keyword args (**kwargs)
     :return: output of fn, and the wrapper function so that the result is return
@@ -73,12 +820,21 @@ def config(fn):
 
     @wraps(fn)
     def wrapper(self, *args, **kwargs):
-        if not self.session.check_enable_mode():
-            self.session.enable()
-        output = fn(self, *args, **kwargs)
-        self.session.save_config()
-        self.session.disconnect()
-        return output
+        if self._pending is not None:
+            return fn(self, *args, **kwargs)
+        with self._borrow(fn.__name__):
+            try:
+                self._pushed = False
+                with phase_timings.timed(self.ip, fn.__name__, "command"):
+                    output = fn(self, *args, **kwargs)
+                if self._pushed and self.save_delay is not None:
+                    save_scheduler.mark_dirty(self.device, self.pool, delay=self.save_delay)
+                elif self._pushed:
+                    with phase_timings.timed(self.ip, fn.__name__, "save_config"):
+                        self.session.save_config()
+                return output
+            finally:
+                self.cache.invalidate(self.device)
 
     return wrapper
 
@@ -131,18 +887,341 @@ def netmask_to_cidr(netmask):
     return sum([str(bin(int(octet))).count("1") for octet in netmask.split(".")])
 
 
+# Lookup tables of the 33 valid netmasks, used by the batch conversions below.
+_PREFIX_NETMASKS = [str(IPv4Network(f"0.0.0.0/{prefix}").netmask) for prefix in range(33)]
+_NETMASK_PREFIXES = {netmask: prefix for prefix, netmask in enumerate(_PREFIX_NETMASKS)}
+_PREFIX_MASK_INTS = [(0xFFFFFFFF << (32 - prefix)) & 0xFFFFFFFF for prefix in range(33)]
+_INVERSE_MASKS = {netmask: inverse_mask(netmask) for netmask in _PREFIX_NETMASKS}
+_INVERSE_MASKS.update({inverse: netmask for netmask, inverse in list(_INVERSE_MASKS.items())})
+
+
+def inverse_masks(netmasks):
+    """
+    Batch version of inverse_mask, valid netmasks and inverse masks are converted by table lookup.
+    :param netmasks: iterable of subnet masks such as 255.255.255.240
+    :return: list of inverse masks
+    """
+    return [_INVERSE_MASKS.get(netmask) or inverse_mask(netmask) for netmask in netmasks]
+
+
+def netmasks_to_cidr(netmasks):
+    """
+    Batch version of netmask_to_cidr, valid netmasks are converted by table lookup.
+    :param netmasks: iterable of netmasks eg. 255.255.255.240
+    :return: list of cidr eg. [28]
+    """
+    prefixes = _NETMASK_PREFIXES
+    return [prefixes[netmask] if netmask in prefixes else netmask_to_cidr(netmask) for netmask in netmasks]
+
+
+def _subnet_to_netmask(subnet):
+    # integer version of cidr_to_netmask for the common a.b.c.d/nn form,
+    # anything else goes to cidr_to_netmask which also raises the errors.
+    net_id, _, cidr = subnet.partition("/")
+    octets = net_id.split(".")
+    if not cidr.isdigit() or int(cidr) > 32 or len(octets) != 4 \
+            or not all(octet.isdigit() and str(int(octet)) == octet and int(octet) < 256 for octet in octets):
+        return cidr_to_netmask(subnet)
+    prefix = int(cidr)
+    address = int.from_bytes(bytes(int(octet) for octet in octets), "big")
+    if address & ~_PREFIX_MASK_INTS[prefix] & 0xFFFFFFFF:
+        return cidr_to_netmask(subnet)
+    return net_id, _PREFIX_NETMASKS[prefix]
+
+
+def cidrs_to_netmask(subnets):
+    """
+    Batch version of cidr_to_netmask, the network id is checked against the cidr with
+    integer operations instead of constructing IPv4Network, repeated subnets are converted once.
+    :param subnets: iterable of subnet/cidr eg. 192.168.1.0/26
+    :return: list of tuple of network id and netmask
+    """
+    converted = dict()
+    result = []
+    for subnet in subnets:
+        if subnet not in converted:
+            converted[subnet] = _subnet_to_netmask(subnet)
+        result.append(converted[subnet])
+    return result
+
+
+# Top level commands which start a configuration section, and global commands which
+# end the current section like ios does when a global command is typed in a sub mode.
+_SECTION_STARTS = ("interface ", "router ", "ip access-list ", "line ", "vlan ", "route-map ",
+                   "class-map ", "policy-map ", "ip prefix-list ")
+_GLOBAL_COMMANDS = ("hostname ", "no interface ", "default interface ", "no router ", "no ip access-list ",
+                    "ip route ", "no ip route ", "ip domain", "username ", "banner ")
+
+
+# Commands which hold a single value, a new value replaces the old line instead of adding to it.
+_REPLACE_COMMANDS = ("hostname", "ip address", "description", "router-id", "bandwidth", "mtu", "ip mtu",
+                     "ip ospf cost", "ip ospf priority", "encapsulation", "speed", "duplex",
+                     "switchport mode", "switchport access vlan", "vrf forwarding", "ip vrf forwarding")
+
+
+def _config_blocks(commands):
+    """
+    Group flat configuration commands into sections.
+    :param commands: list of configuration command lines.
+    :return: list of tuples of (section header or None for global commands, list of commands).
+    """
+    blocks = []
+    header = None
+    for command in commands:
+        command = " ".join(command.split())
+        if not command or command.startswith("!"):
+            continue
+        if command in ("exit", "end"):
+            header = None
+        elif command.startswith(_SECTION_STARTS):
+            header = command
+            blocks.append((header, []))
+        elif header is None or command.startswith(_GLOBAL_COMMANDS):
+            header = None
+            blocks.append((None, [command]))
+        else:
+            blocks[-1][1].append(command)
+    return blocks
+
+
+def _has_command(lines, command):
+    # "no x" is already configured if the line is in the config or x is not in the config.
+    if command.startswith("no "):
+        negated = command[3:]
+        return command in lines or not any(line == negated or line.startswith(negated + " ") for line in lines)
+    return command in lines
+
+
+class RunningConfig:
+    """
+    Snapshot of the running-config indexed by section such as interface Ethernet0/0 or router ospf 1,
+    used to find the commands which would change the router.
+    """
+
+    def __init__(self, running_config):
+        """
+        :param running_config: output of show running-config.
+        """
+        self.globals = set()
+        self.sections = dict()
+        header = None
+        for line in running_config.splitlines():
+            if not line.strip() or line.startswith(("!", "Building configuration", "Current configuration")):
+                continue
+            if line.startswith(" ") and header is not None:
+                self.sections[header].add(" ".join(line.split()))
+            else:
+                line = " ".join(line.split())
+                header = line.lower()
+                self.globals.add(line)
+                self.sections.setdefault(header, set())
+
+    def delta(self, commands):
+        """
+        Remove the commands which are already in the running-config.
+        :param commands: list of configuration command lines.
+        :return: list of commands which change the router, empty list if nothing changes.
+        """
+        delta = []
+        for header, children in _config_blocks(commands):
+            if header is None:
+                command = children[0]
+                if command.startswith("no interface "):
+                    configured = command[3:].lower() not in self.sections
+                elif command.startswith("default interface "):
+                    configured = False
+                else:
+                    configured = _has_command(self.globals, command)
+                if not configured:
+                    delta.append(command)
+                continue
+            lines = self.sections.get(header.lower())
+            missing = children if lines is None else [child for child in children
+                                                      if not _has_command(lines, child)]
+            if lines is None or missing:
+                delta.extend([header, *missing, "exit"])
+        return delta
+
+    def apply(self, commands):
+        """
+        Update the snapshot with the commands sent to the router.
+        :param commands: list of configuration command lines.
+        :return:
+        """
+        for header, children in _config_blocks(commands):
+            if header is None:
+                command = children[0]
+                if command.startswith(("no interface ", "default interface ")):
+                    self.sections.pop(command.split(" ", 1)[1].lower(), None)
+                    self.globals.discard(command.split(" ", 1)[1])
+                    if command.startswith("default "):
+                        self.sections[command[8:].lower()] = set()
+                else:
+                    self._apply_lines(self.globals, [command])
+                continue
+            self.globals.add(header)
+            self._apply_lines(self.sections.setdefault(header.lower(), set()), children)
+
+    @staticmethod
+    def _apply_lines(lines, commands):
+        for command in commands:
+            if command.startswith("no "):
+                negated = command[3:]
+                lines.difference_update({line for line in lines
+                                         if line == negated or line.startswith(negated + " ")})
+            else:
+                keyword = next((keyword for keyword in _REPLACE_COMMANDS if command.startswith(keyword + " ")), None)
+                # secondary addresses are added next to the primary address.
+                if keyword is not None and not command.endswith(" secondary"):
+                    lines.difference_update({line for line in lines
+                                             if line == f"no {keyword}" or line.startswith(keyword + " ")
+                                             and not line.endswith(" secondary")})
+                lines.add(command)
+
+
+# running-config snapshots by SessionPool.device_key, entries are (monotonic time fetched, RunningConfig).
+_running_configs = dict()
+_running_configs_lock = threading.Lock()
+# seconds a snapshot is trusted, changes made outside of this process are seen after this.
+RUNNING_CONFIG_TTL = 60
+
+
+def invalidate_running_config(device=None):
+    """
+    Forget the running-config snapshot of the device, or of all devices, so that minimal_delta
+    fetches show running-config again. Call it after configuring a router without CiscoIOS.
+    :param device: netmiko device dictionary.
+    :return:
+    """
+    with _running_configs_lock:
+        if device is None:
+            _running_configs.clear()
+        else:
+            _running_configs.pop(SessionPool.device_key(device), None)
+
+
+def _acl_endpoint(rule, side):
+    # IPv4Network of the source or destination of the acl rule,
+    # None if the rule uses a wildcard which is not a contiguous mask.
+    if rule.get(f"{side}_host") is not None:
+        return IPv4Network(rule[f"{side}_host"])
+    netmask = _INVERSE_MASKS.get(rule.get(f"{side}_wildcard"))
+    if rule.get(f"{side}_net") is None or netmask is None or _NETMASK_PREFIXES.get(netmask) is None:
+        return None
+    return IPv4Network(f"{rule[f'{side}_net']}/{netmask}", strict=False)
+
+
+def _set_acl_endpoint(rule, side, network):
+    for key in ("host", "net", "wildcard"):
+        rule.pop(f"{side}_{key}", None)
+    if network.prefixlen == 32:
+        rule[f"{side}_host"] = str(network.network_address)
+    else:
+        rule[f"{side}_net"] = str(network.network_address)
+        rule[f"{side}_wildcard"] = _INVERSE_MASKS[str(network.netmask)]
+
+
+def _covers(network, other):
+    # True if other is within network, compared as integers.
+    net, prefix = network
+    other_net, other_prefix = other
+    return prefix <= other_prefix and other_net & _PREFIX_MASK_INTS[prefix] == net
+
+
+def _merge_acl_run(run, side):
+    # rules in run have the same action, proto, eq and the other side, so the networks
+    # on this side can be collapsed without changing what the acl permits or denies.
+    if len(run) == 1:
+        return run
+    merged = []
+    for network in collapse_addresses(rule["_" + side] for rule in run):
+        rule = dict(run[0])
+        rule["_" + side] = network
+        if merged:
+            rule.pop("remark", None)
+        merged.append(rule)
+    return merged
+
+
+def _merge_acl_rules(rules, side):
+    other = "dst" if side == "src" else "src"
+    merged = []
+    run = []
+    for rule in rules:
+        key = None if rule["_src"] is None or rule["_dst"] is None else \
+            (rule.get("action"), rule.get("proto"), rule.get("eq"), rule["_" + other])
+        if run and (key is None or rule.get("remark") or key != run[0]["_key"]):
+            merged.extend(_merge_acl_run(run, side))
+            run = []
+        if key is None:
+            merged.append(rule)
+        else:
+            rule["_key"] = key
+            run.append(rule)
+    merged.extend(_merge_acl_run(run, side))
+    return merged
+
+
+def compile_acl(rules):
+    """
+    Compile a list of extended acl rules before rendering with named_acl_extended.j2.
+    Rules which can never match because an earlier rule already matches all their traffic
+    are dropped, consecutive rules with the same action, protocol, port and destination
+    (or source) are merged by collapsing their networks with ipaddress.collapse_addresses.
+    Rules with a wildcard which is not a contiguous mask are kept as they are.
+    :param rules: list of dictionary with the keys of named_acl_extended.j2 eg.
+    {"action": "permit", "proto": "tcp", "src_net": "10.0.0.0", "src_wildcard": "0.0.0.255",
+    "dst_host": "192.168.1.1", "eq": 443}
+    :return: list of compiled rules, same format as the rules.
+    """
+    kept = []
+    earlier = []
+    for rule in rules:
+        rule = dict(rule, _src=_acl_endpoint(rule, "src"), _dst=_acl_endpoint(rule, "dst"))
+        if rule["_src"] is not None and rule["_dst"] is not None:
+            src = (int(rule["_src"].network_address), rule["_src"].prefixlen)
+            dst = (int(rule["_dst"].network_address), rule["_dst"].prefixlen)
+            proto, eq = rule.get("proto"), rule.get("eq")
+            if any((e_proto == "ip" or (e_proto == proto and e_eq == eq))
+                   and _covers(e_src, src) and _covers(e_dst, dst)
+                   for e_proto, e_eq, e_src, e_dst in earlier):
+                continue
+            earlier.append((proto, eq, src, dst))
+        kept.append(rule)
+    compiled = []
+    for rule in _merge_acl_rules(_merge_acl_rules(kept, "src"), "dst"):
+        if rule["_src"] is not None and rule["_dst"] is not None:
+            _set_acl_endpoint(rule, "src", rule["_src"])
+            _set_acl_endpoint(rule, "dst", rule["_dst"])
+        compiled.append({key: value for key, value in rule.items() if not key.startswith("_")})
+    return compiled
+
+
 class CiscoIOS:
     """
     Only for Cisco IOS XE.
     """
 
-    def __init__(self, ip="192.168.1.1", username="admin", password="password", secret=None):
+    def __init__(self, ip="192.168.1.1", username="admin", password="password", secret=None, pool=None,
+                 cache=None, minimal_delta=False, port=22, save_delay=None, file_push_threshold=None):
         """
         information for netmiko to connect to cisco ios based router.
+        The ssh session is borrowed from the pool when a method is called, so the same
+        object can be used for many calls.
         :param ip: management ip address of router
         :param username: username of router
         :param password: password of router
         :param secret: optional, this is the enable password of router.
+        :param pool: optional, SessionPool to borrow sessions from, default is the shared session_pool.
+        :param cache: optional, ShowCache for the show methods, default is the shared show_cache.
+        :param minimal_delta: if True the config methods only send the commands which are not in
+        the running-config snapshot, and nothing is sent or saved if the router already has the config.
+        :param port: ssh port of router.
+        :param save_delay: optional, seconds to wait for more changes before one save_config,
+        default is to save after every config method.
+        :param file_push_threshold: optional, configuration sets with at least this many commands are
+        uploaded to flash: with scp and merged with one copy to running-config instead of being sent
+        line by line, the router needs ip scp server enable.
         """
         self.ip = ip
         self.username = username
@@ -151,12 +1230,174 @@ class CiscoIOS:
         device = dict(
             device_type="cisco_ios",
             ip=self.ip,
+            port=port,
             username=self.username,
             password=self.password,
         )
         if secret is not None:
             device.update(dict(secret=self.secret))
-        self.session = ConnectHandler(**device)
+        self.device = device
+        self.pool = session_pool if pool is None else pool
+        self.cache = show_cache if cache is None else cache
+        self.session = None
+        self.minimal_delta = minimal_delta
+        self.save_delay = save_delay
+        self.file_push_threshold = file_push_threshold
+        self._pending = None
+        self._pushed = False
+        self._refresh_snapshot = False
+
+    @contextmanager
+    def _borrow(self, method):
+        """
+        Borrow a session from the pool as self.session and ensure enable mode,
+        connect and enable are timed in phase_timings.
+        :param method: name of the method, for the timings.
+        :return: netmiko connection object.
+        """
+        with phase_timings.timed(self.ip, method, "connect"):
+            session = self.pool.acquire(self.device)
+        self.session = session
+        try:
+            with phase_timings.timed(self.ip, method, "enable"):
+                if not session.check_enable_mode():
+                    session.enable()
+            yield session
+        except BaseException:
+            self.pool.release(self.device, session, discard=True)
+            raise
+        finally:
+            self.session = None
+        self.pool.release(self.device, session)
+
+    def _push(self, commands):
+        """
+        Send the configuration commands, or queue them if a transaction is in progress.
+        :param commands: list of configuration command lines.
+        :return: command line output, empty string if queued.
+        """
+        if self._pending is not None:
+            self._pending.extend(commands)
+            return ""
+        snapshot = None
+        refresh, self._refresh_snapshot = self._refresh_snapshot, False
+        if self.minimal_delta:
+            snapshot = self.running_config(refresh=refresh)
+            commands = snapshot.delta(commands)
+            if not commands:
+                return ""
+        try:
+            if self.file_push_threshold is not None and len(commands) >= self.file_push_threshold:
+                output = self._push_file(commands)
+            else:
+                output = self.session.send_config_set(commands)
+        except BaseException:
+            # the router may have part of the commands, fetch the running-config again next time.
+            invalidate_running_config(self.device)
+            raise
+        self._pushed = True
+        if snapshot is not None:
+            snapshot.apply(commands)
+        if any(command.startswith("hostname ") for command in commands):
+            # the pooled session is reused, so it must learn the new prompt of the router,
+            # the other idle sessions of the router still expect the old prompt and are closed.
+            self.session.set_base_prompt()
+            self.pool.close(self.device)
+        return output
+
+    def _push_file(self, commands, file_system="flash:"):
+        """
+        Upload the configuration commands as a file with scp, merge it into the running-config
+        with copy <file> running-config and delete the file.
+        :param commands: list of configuration command lines.
+        :param file_system: file system of the router to upload to.
+        :return: command line output
+        """
+        filename = f"netscript-{uuid.uuid4().hex[:8]}.cfg"
+        with tempfile.NamedTemporaryFile("w", suffix=".cfg", delete=False) as f:
+            f.write("\n".join(commands) + "\nend\n")
+        try:
+            file_transfer(self.session, source_file=f.name, dest_file=filename, file_system=file_system,
+                          direction="put", overwrite_file=True)
+        finally:
+            os.remove(f.name)
+        try:
+            output = self.session.send_command(f"copy {file_system}/{filename} running-config",
+                                               expect_string=r"\[running-config\]\?")
+            # the default prompt detection does not work for the bare enter, so expect a prompt explicitly,
+            # any prompt as the merged config can change the hostname.
+            output += self.session.send_command("\n", expect_string=r"[>#]\s*$", read_timeout=300)
+        finally:
+            self.session.send_command_timing(f"delete /force {file_system}/{filename}")
+        return output
+
+    def running_config(self, refresh=False):
+        """
+        Get the running-config snapshot of the router, show running-config is sent once per router
+        every RUNNING_CONFIG_TTL seconds and at the commit of a transaction,
+        the snapshot is updated with the commands pushed by the config methods.
+        Must be called within a method which has a session, eg. a config method.
+        :param refresh: fetch the running-config again.
+        :return: RunningConfig object
+        """
+        key = SessionPool.device_key(self.device)
+        with _running_configs_lock:
+            fetched, snapshot = _running_configs.get(key, (0, None))
+        if snapshot is None or refresh or monotonic() - fetched > RUNNING_CONFIG_TTL:
+            snapshot = RunningConfig(self.session.send_command("show running-config"))
+            with _running_configs_lock:
+                _running_configs[key] = (monotonic(), snapshot)
+        return snapshot
+
+    @contextmanager
+    def transaction(self):
+        """
+        Queue the config methods called in the with block and push them as one configuration set
+        with one save_config when the block exits. Nothing is pushed if the block raises an exception.
+        Usage:
+        with router.transaction():
+            router.set_intf(**intf_config)
+            router.set_ospf(**ospf_config)
+        :return: this CiscoIOS object.
+        """
+        if self._pending is not None:
+            raise RuntimeError("A transaction is already in progress.")
+        self._pending = []
+        try:
+            yield self
+        except BaseException:
+            # also on GeneratorExit or KeyboardInterrupt, else the config methods would queue forever.
+            self._pending = None
+            raise
+        self.commit()
+
+    def commit(self):
+        """
+        Push the queued commands of the transaction.
+        :return: command line output
+        """
+        commands, self._pending = self._pending, None
+        if not commands:
+            return ""
+        # the delta of a transaction is computed against a fresh running-config.
+        self._refresh_snapshot = True
+        return self.send_config(commands)
+
+    def flush_save(self):
+        """
+        Save the configuration now if a delayed save is pending.
+        :return:
+        """
+        save_scheduler.flush(self.device)
+
+    def close(self):
+        """
+        Save the configuration if a delayed save is pending, then
+        disconnect the idle sessions of this router in the pool.
+        :return:
+        """
+        self.flush_save()
+        self.pool.close(self.device)
 
     @show
     def show_intf_brief(self):
@@ -170,6 +1411,76 @@ class CiscoIOS:
     def show_version(self):
         return self.session.send_command("show version")
 
+    def stream_command(self, command, chunk_size=65536, read_timeout=120):
+        """
+        Send a show command and yield the output in chunks as it arrives instead of
+        holding the whole output in memory, eg. show tech-support or show running-config all.
+        The output is not cached, the session is borrowed until the generator is exhausted or closed.
+        :param command: show command.
+        :param chunk_size: number of characters to collect before a chunk is yielded.
+        :param read_timeout: seconds without any output before giving up.
+        :return: generator of output chunks, the command echo and the prompt are removed.
+        """
+        with self._borrow("stream_command") as session:
+            prompt = session.find_prompt()
+            session.clear_buffer()
+            session.write_channel(session.normalize_cmd(command))
+            pending = ""
+            carry = ""
+            echoed = False
+            # the last characters are held back as they could be the beginning of the prompt.
+            hold = len(prompt) + 2
+            deadline = monotonic() + read_timeout
+            while True:
+                data = session.read_channel()
+                if not data:
+                    if monotonic() > deadline:
+                        raise TimeoutError(f"No output from {self.ip} for {read_timeout}s after {command}.")
+                    sleep(0.05)
+                    continue
+                deadline = monotonic() + read_timeout
+                # only the new data is normalized, trailing \r are held back as a \r\n can be split across reads.
+                data = carry + data
+                stripped = data.rstrip("\r")
+                carry = data[len(stripped):]
+                pending += session.normalize_linefeeds(stripped)
+                if not echoed:
+                    echo = pending.find(command)
+                    if echo < 0 or "\n" not in pending[echo:]:
+                        continue
+                    pending = pending[echo:].split("\n", 1)[1]
+                    echoed = True
+                if pending.rstrip().endswith(prompt):
+                    output = pending.rstrip()[:-len(prompt)]
+                    if output:
+                        yield output
+                    return
+                if len(pending) >= chunk_size + hold:
+                    yield pending[:-hold]
+                    pending = pending[-hold:]
+
+    def capture_to_file(self, command, path, compresslevel=6):
+        """
+        Stream the output of the show command into a gzip compressed file with bounded memory.
+        :param command: show command.
+        :param path: file path, eg. r1-show-tech.txt.gz
+        :param compresslevel: gzip compression level 1 to 9.
+        :return: path of the file.
+        """
+        with gzip.open(path, "wt", compresslevel=compresslevel) as f:
+            for chunk in self.stream_command(command):
+                f.write(chunk)
+        return path
+
+    @config
+    def send_config(self, commands):
+        """
+        Send any list of configuration commands.
+        :param commands: list of configuration command lines.
+        :return: command line output
+        """
+        return self._push(list(commands))
+
     @config
     def set_hostname(self, hostname):
         """
@@ -177,13 +1488,13 @@ class CiscoIOS:
         :param hostname: desired name for the router
         :return: command line output
         """
-        return self.session.send_config_set([f"hostname {hostname}"])
+        return self._push([f"hostname {hostname}"])
 
     @config
     def set_intf(self, **intf_config):
         template = config_template(template_file="intf.j2")
         config = template.render(**intf_config)
-        return self.session.send_config_set([cmd.strip(" ") for cmd in config.splitlines()])
+        return self._push([cmd.strip(" ") for cmd in config.splitlines()])
 
     @config
     def remove_loopback(self, loop_id=0):
@@ -192,7 +1503,7 @@ class CiscoIOS:
         :param loop_id: the loopback interface id to remove.
         :return: command line output
         """
-        return self.session.send_config_set([f"no interface loopback{loop_id}"])
+        return self._push([f"no interface loopback{loop_id}"])
 
     @config
     def set_ospf(self, **ospf_config):
@@ -203,7 +1514,7 @@ class CiscoIOS:
         """
         template = config_template(template_file="ospf.j2")
         config = template.render(**ospf_config)
-        return self.session.send_config_set(config.splitlines())
+        return self._push(config.splitlines())
 
     @config
     def acl_insert_one(self, **extended_acl_config):
@@ -214,7 +1525,23 @@ class CiscoIOS:
         """
         template = config_template(template_file="named_acl_extended.j2")
         config = template.render(**extended_acl_config)
-        return self.session.send_config_set(config.splitlines())
+        return self._push(config.splitlines())
+
+    @config
+    def acl_insert_many(self, acl_name, rules):
+        """
+        Compile the rules with compile_acl, render the whole acl and push it as one configuration set.
+        :param acl_name: name of the extended acl.
+        :param rules: list of rules, see compile_acl.
+        :return: command line output
+        """
+        template = config_template(template_file="named_acl_extended.j2")
+        header = f"ip access-list extended {acl_name}"
+        commands = [header]
+        for rule in compile_acl(rules):
+            config = template.render(**rule, acl_name=acl_name)
+            commands.extend(line for line in config.splitlines() if line and line != header)
+        return self._push(commands)
 
     @config
     def apply_acl(self, **apply_acl):
@@ -225,7 +1552,7 @@ class CiscoIOS:
         """
         template = config_template(template_file="apply_acl.j2")
         config = template.render(**apply_acl)
-        return self.session.send_config_set(config.splitlines())
+        return self._push(config.splitlines())
 
     @config
     def default_intf(self, intf_id):
@@ -234,4 +1561,4 @@ class CiscoIOS:
         :param intf_id:
         :return: command line output
         """
-        return self.session.send_config_set([f"default interface {intf_id}"])
+        return self._push([f"default interface {intf_id}"])